@@ -0,0 +1,87 @@
+#! /usr/bin/env python3
+"""
+Benchmarks compression and chunking presets for EDEPSIM_H5 files
+"""
+
+import os
+import time
+import tempfile
+import fire
+import h5py
+
+from convert_edepsim_roottoh5 import HDF5Writer, output_dtypes
+from read_edepsim_h5 import openFull
+
+# Rewrite the datasets of `data` (by path, with those of a group such as
+# segments/<container> sharing its dtype) with one preset, the same way the
+# converter does (appending batches of block_rows rows), then read them back.
+# Returns the file size and the write and read times in seconds.
+def benchmarkPreset(data, path, compression, shuffle, chunk_size, block_rows):
+    dtypes = {name.split("/")[0]: rows.dtype for name, rows in data.items()}
+    groups = {name.split("/")[0] for name in data if "/" in name}
+    start = time.perf_counter()
+    with HDF5Writer(path, chunk_size, compression=compression, shuffle=shuffle,
+                    dtypes=dtypes, groups=groups) as writer:
+        for name, rows in data.items():
+            for first in range(0, len(rows), block_rows):
+                writer.append(name, rows[first:first+block_rows])
+    write_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with h5py.File(path, 'r') as f:
+        for name in data:
+            f[name][:]
+    read_time = time.perf_counter() - start
+
+    return os.path.getsize(path), write_time, read_time
+
+# Run the benchmark.
+def benchmark(input_file, compression=["none", "gzip", "gzip:1", "lzf", "blosc:lz4", "blosc:zstd"],
+              shuffle=[False, True], chunk_size=["auto", "small", "medium", "large"],
+              block_rows=100000, tmp_dir=None):
+
+    """
+    Rewrite the datasets of an EDEPSIM_H5 file with every combination of the
+    given compression, shuffle and chunk size presets, and report the
+    compression ratio (uncompressed bytes / file size) and the write and read
+    throughput (uncompressed MB/s). Presets that can't be used here (e.g.
+    Blosc without hdf5plugin) are skipped. Files written with --packed are
+    rewritten in the full layout; with --split_dets, the segments of every
+    container are.
+
+    Args:
+        input_file (str): sample EDEPSIM_H5 file, as written by convert_edepsim_roottoh5.py
+        compression (list): compression specs, as for convert_edepsim_roottoh5.py
+        shuffle (list): shuffle settings to try with each compression
+        chunk_size (list): chunk sizes, in rows or as presets
+        block_rows (int): rows per append, standing in for the converter's flushes
+        tmp_dir (str): where to write the rewritten files. Default: system temp dir
+    """
+
+    f, views = openFull(input_file)
+    with f:
+        data = {name: view[:] for name, view in views.items() if name.split("/")[0] in output_dtypes}
+    nbytes = sum(rows.nbytes for rows in data.values())
+    print(f"{input_file}: {nbytes / 1e6:.1f} MB uncompressed in",
+          ", ".join(f"{name} ({len(rows)} rows)" for name, rows in data.items()))
+    print(f"{'compression':>12} {'shuffle':>7} {'chunk':>8} {'size MB':>9} {'ratio':>6} "
+          f"{'write MB/s':>10} {'read MB/s':>10}")
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        path = os.path.join(tmp, "benchmark.hdf5")
+        for comp in compression:
+            for shuf in shuffle:
+                for chunks in chunk_size:
+                    try:
+                        size, write_time, read_time = benchmarkPreset(data, path, comp, shuf, chunks, block_rows)
+                    except (ImportError, ValueError) as e:
+                        print(f"{comp:>12} {str(shuf):>7} {str(chunks):>8}  skipped: {e}")
+                        continue
+                    finally:
+                        if os.path.exists(path):
+                            os.remove(path)
+                    print(f"{comp:>12} {str(shuf):>7} {str(chunks):>8} {size / 1e6:9.1f} {nbytes / size:6.2f} "
+                          f"{nbytes / 1e6 / write_time:10.1f} {nbytes / 1e6 / read_time:10.1f}")
+
+if __name__ == "__main__":
+    fire.Fire(benchmark)
@@ -0,0 +1,288 @@
+#! /usr/bin/env python3
+"""
+Benchmarks convert_edepsim_roottoh5.py on synthetic EDEPSIM_SPILLS inputs
+"""
+
+import os
+import json
+import time
+import tempfile
+import multiprocessing
+import fire
+import ROOT
+
+libTG4Event = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "..", "run-spill-build", "libTG4Event", "libTG4Event.so")
+
+# Load the TG4Event classes, unless ROOT already has them (e.g. from edep-sim),
+# along with their headers from the library's directory, which the input
+# writer needs to compile. This has to happen before convert_edepsim_roottoh5
+# is imported.
+def loadTG4Event(tg4event_lib):
+    if ROOT.TClass.GetClass("TG4Event") and ROOT.TClass.GetClass("TG4Event").IsLoaded():
+        return
+    ROOT.gInterpreter.AddIncludePath(os.path.dirname(os.path.abspath(tg4event_lib)))
+    if ROOT.gSystem.Load(tg4event_lib) < 0:
+        raise RuntimeError(f"Can't load {tg4event_lib}; build it with run-spill-build/makeLibTG4Event.sh")
+
+# Declare the C++ writer of synthetic inputs (once)
+input_writer_declared = False
+def declareInputWriter():
+    global input_writer_declared
+    if input_writer_declared:
+        return
+
+    ROOT.gInterpreter.Declare("""
+    #include "TFile.h"
+    #include "TTree.h"
+    #include "TMap.h"
+    #include "TObjString.h"
+    #include "TParameter.h"
+    #include "TRandom3.h"
+    #include "TG4Event.h"
+
+    // Write an edep-sim-like file laid out as run-spill-build writes it: the
+    // EDepSimEvents tree, event_spill_map, spillPeriod_s and a matching
+    // DetSimPassThru/gRooTracker tree. Every event has one vertex, two primary
+    // trajectories (also in the GENIE final state) and the given numbers of
+    // trajectories, points per trajectory, containers and segments per
+    // container (the first container being volTPCActive).
+    void convert2h5bench_writeInput(const char* path, int spills, int eventsPerSpill, int trajectories,
+                                    int points, int detectors, int segments, double spillPeriod_s,
+                                    unsigned seed) {
+        const int runId = 1;
+        const std::vector<std::string> codes = {"nu:14;tgt:1000180400;N:2112;proc:Weak[CC],QES;",
+                                                "nu:14;tgt:1000180400;N:2212;proc:Weak[NC],RES;res:0;",
+                                                "nu:14;tgt:1000180400;proc:Weak[CC],DIS;",
+                                                "nu:14;tgt:1000180400;proc:Weak[CC],MEC;"};
+        TRandom3 rng(seed);
+        TFile outFile(path, "RECREATE");
+
+        TTree* tree = new TTree("EDepSimEvents", "Synthetic edep-sim events");
+        TG4Event* event = new TG4Event();
+        tree->Branch("Event", &event);
+
+        TTree* genie = new TTree("gRooTracker", "Synthetic GENIE records");
+        int n = 0;
+        std::vector<int> pdg(1000), status(1000);
+        std::vector<double> p4(4*1000), vtx(4);
+        TObjString* code = new TObjString();
+        genie->Branch("StdHepN", &n, "StdHepN/I");
+        genie->Branch("StdHepPdg", pdg.data(), "StdHepPdg[StdHepN]/I");
+        genie->Branch("StdHepStatus", status.data(), "StdHepStatus[StdHepN]/I");
+        genie->Branch("StdHepP4", p4.data(), "StdHepP4[StdHepN][4]/D");
+        genie->Branch("EvtVtx", vtx.data(), "EvtVtx[4]/D");
+        genie->Branch("EvtCode", "TObjString", &code);
+
+        TMap* event_spill_map = new TMap(spills*eventsPerSpill);
+        const int nPrimaries = std::min(2, trajectories);
+
+        for (int spill = 0; spill < spills; ++spill) {
+            for (int iEvent = 0; iEvent < eventsPerSpill; ++iEvent) {
+                const int eventId = spill*eventsPerSpill + iEvent;
+                const double t0 = 1e9*spillPeriod_s*spill + rng.Uniform(0, 1e4);
+                const double x0 = rng.Uniform(-600, 600), y0 = rng.Uniform(-600, 600), z0 = rng.Uniform(-600, 600);
+                event->RunId = runId;
+                event->EventId = eventId;
+
+                event->Primaries.assign(1, TG4PrimaryVertex());
+                event->Primaries[0].Position.SetXYZT(x0, y0, z0, t0);
+
+                event->Trajectories.assign(trajectories, TG4Trajectory());
+                for (int iTraj = 0; iTraj < trajectories; ++iTraj) {
+                    auto& traj = event->Trajectories[iTraj];
+                    traj.TrackId = iTraj;
+                    traj.ParentId = iTraj < nPrimaries ? -1 : int(rng.Integer(iTraj));
+                    traj.PDGCode = iTraj == 0 ? 13 : (iTraj % 3 ? 2212 : 11);
+                    traj.Name = iTraj == 0 ? "mu-" : (iTraj % 3 ? "proton" : "e-");
+                    const double mass = iTraj == 0 ? 105.658 : (iTraj % 3 ? 938.272 : 0.511);
+                    double px = rng.Gaus(0, 300), py = rng.Gaus(0, 300), pz = rng.Uniform(100, 2000);
+                    traj.InitialMomentum.SetXYZM(px, py, pz, mass);
+                    traj.Points.assign(points, TG4TrajectoryPoint());
+                    double x = x0, y = y0, z = z0, t = t0;
+                    for (int iPoint = 0; iPoint < points; ++iPoint) {
+                        auto& point = traj.Points[iPoint];
+                        point.Position.SetXYZT(x, y, z, t);
+                        point.Momentum.SetXYZ(px, py, pz);
+                        point.Process = iPoint ? 2 : 0;
+                        point.Subprocess = iPoint ? 2 : 0;
+                        x += rng.Gaus(0, 5); y += rng.Gaus(0, 5); z += rng.Gaus(0, 5); t += rng.Uniform(0, 0.1);
+                        px *= 0.9; py *= 0.9; pz *= 0.9;
+                    }
+                    if (iTraj < nPrimaries) {
+                        TG4PrimaryParticle particle;
+                        particle.TrackId = iTraj;
+                        particle.Name = traj.Name;
+                        particle.PDGCode = traj.PDGCode;
+                        particle.Momentum = traj.InitialMomentum;
+                        event->Primaries[0].Particles.push_back(particle);
+                    }
+                }
+
+                event->SegmentDetectors.clear();
+                for (int iDet = 0; iDet < detectors; ++iDet) {
+                    std::vector<TG4HitSegment> hits(segments);
+                    for (auto& hit : hits) {
+                        const int track = trajectories ? int(rng.Integer(trajectories)) : 0;
+                        const double x = rng.Uniform(-600, 600), y = rng.Uniform(-600, 600), z = rng.Uniform(-600, 600);
+                        const double t = t0 + rng.Uniform(0, 100);
+                        hit.Contrib.assign(1, track);
+                        hit.PrimaryId = track;
+                        hit.EnergyDeposit = rng.Uniform(0, 2);
+                        hit.SecondaryDeposit = 0;
+                        hit.TrackLength = rng.Uniform(0, 3);
+                        hit.Start.SetXYZT(x, y, z, t);
+                        hit.Stop.SetXYZT(x + rng.Gaus(0, 1), y + rng.Gaus(0, 1), z + rng.Gaus(0, 1), t + 0.01);
+                    }
+                    event->SegmentDetectors.emplace_back(iDet ? "volDet" + std::to_string(iDet) : "volTPCActive", hits);
+                }
+                tree->Fill();
+
+                // Neutrino and target, the primaries as final state particles
+                // (in GeV) and an intermediate particle
+                n = 0;
+                auto add = [&](int particlePdg, int particleStatus, double px, double py, double pz, double e) {
+                    pdg[n] = particlePdg;
+                    status[n] = particleStatus;
+                    p4[4*n] = px; p4[4*n+1] = py; p4[4*n+2] = pz; p4[4*n+3] = e;
+                    ++n;
+                };
+                const double eNu = rng.Uniform(0.5, 10);
+                add(14, 0, 0, 0, eNu, eNu);
+                add(1000180400, 0, 0, 0, 0, 37.2);
+                for (int iTraj = 0; iTraj < nPrimaries; ++iTraj) {
+                    const auto& p = event->Trajectories[iTraj].InitialMomentum;
+                    add(event->Trajectories[iTraj].PDGCode, 1, p.X()/1000, p.Y()/1000, p.Z()/1000, p.T()/1000);
+                }
+                add(2000000101, 3, 0, 0, 0, 0);
+                vtx[0] = x0/1000; vtx[1] = y0/1000; vtx[2] = z0/1000; vtx[3] = t0;
+                code->SetString(codes[eventId % codes.size()].c_str());
+                genie->Fill();
+
+                event_spill_map->Add(new TObjString((std::to_string(runId) + " " + std::to_string(eventId)).c_str()),
+                                     new TObjString(std::to_string(spill).c_str()));
+            }
+        }
+
+        outFile.cd();
+        tree->Write();
+        event_spill_map->Write("event_spill_map", 1);
+        TParameter<double>("spillPeriod_s", spillPeriod_s).Write();
+        outFile.mkdir("DetSimPassThru");
+        outFile.cd("DetSimPassThru");
+        genie->Write();
+        outFile.Close();
+    }
+    """)
+
+    input_writer_declared = True
+
+# Convert one input (meant to run in a fresh process, so its peak memory is its
+# own) and send the profile written by dump(), plus the event and segment
+# rates, through a pipe; or, if the conversion fails, a dict with its error.
+def runCase(connection, tg4event_lib, input_file, output_file, options):
+    loadTG4Event(tg4event_lib)
+    from convert_edepsim_roottoh5 import dump
+
+    try:
+        dump(input_file, output_file, profile_phases=True, **options)
+    except Exception as e:
+        connection.send(dict(error=f"{type(e).__name__}: {e}"))
+        return
+    with open(output_file + ".profile.json") as f:
+        report = json.load(f)
+    os.remove(output_file + ".profile.json")
+    os.remove(output_file)
+
+    report["events_per_s"] = report["entries"] / report["wall_time"]
+    report["segments_per_s"] = report["rows"]["segments"]["rows_per_s"]
+    report["peak_memory_mb"] = max(report["peak_rss_mb"], report["peak_rss_children_mb"])
+    connection.send(report)
+
+# Run the benchmark.
+def benchmark(spills=10, events_per_spill=50, trajectories=50, points=10, detectors=2, segments=200,
+              engine=["root", "bulk"], nproc=[1], block_size=1000, queue_depth=0, spill_period_s=1.2,
+              seed=1, member_wise=True, tg4event_lib=libTG4Event, tmp_dir=None, results=None):
+
+    """
+    Write a synthetic edep-sim-like input (EDepSimEvents with TG4Event objects,
+    event_spill_map, spillPeriod_s and DetSimPassThru/gRooTracker, as
+    run-spill-build writes them), convert it with every combination of the
+    given engines and process counts, and report events/s, segments/s and peak
+    memory. Each conversion runs in its own process; one that fails is
+    reported as such and the benchmark carries on with the others.
+
+    Args:
+        spills (int): spills in the input
+        events_per_spill (int): events in each spill
+        trajectories (int): trajectories per event, the first two primaries
+        points (int): points per trajectory
+        detectors (int): SegmentDetectors containers per event, the first being
+            volTPCActive
+        segments (int): hit segments per container
+        engine (list): engines to benchmark
+        nproc (list): worker process counts to benchmark
+        block_size (int): entries per block, as for convert_edepsim_roottoh5.py
+        queue_depth (int): pipeline queue depth, as for convert_edepsim_roottoh5.py
+        spill_period_s (float): spill period written to the input
+        seed (int): random seed of the input
+        member_wise (bool): write the collections of objects in the input
+            member-wise, as ROOT (and so edep-sim) does by default, rather
+            than object-wise
+        tg4event_lib (str): libTG4Event.so, used unless ROOT already has TG4Event.
+            Default: the one built in run-spill-build/libTG4Event
+        tmp_dir (str): where to write the input and outputs. Default: system temp dir
+        results (str): also append each result as a line of JSON to this file,
+            to track the converter's performance over time
+    """
+
+    engines = [engine] if isinstance(engine, str) else engine
+    nprocs = [nproc] if isinstance(nproc, int) else nproc
+    loadTG4Event(tg4event_lib)
+    declareInputWriter()
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        input_file = os.path.join(tmp, "benchmark.EDEPSIM_SPILLS.root")
+        output_file = os.path.join(tmp, "benchmark.EDEPSIM.hdf5")
+
+        start = time.perf_counter()
+        ROOT.TVirtualStreamerInfo.SetStreamMemberWise(member_wise)
+        ROOT.convert2h5bench_writeInput(input_file, spills, events_per_spill, trajectories, points,
+                                        detectors, segments, spill_period_s, seed)
+        print(f"{input_file}: {spills * events_per_spill} events, {os.path.getsize(input_file) / 1e6:.1f} MB, "
+              f"written in {time.perf_counter() - start:.1f} s")
+        print(f"{'engine':>8} {'nproc':>5} {'events/s':>10} {'segments/s':>12} {'peak MB':>8}")
+
+        # Spawned rather than forked, so no state carries over between cases,
+        # and not a Pool worker, which couldn't start dump()'s own workers
+        context = multiprocessing.get_context("spawn")
+        for eng in engines:
+            for n in nprocs:
+                options = dict(engine=eng, nproc=n, block_size=block_size, queue_depth=queue_depth)
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(target=runCase, args=(sender, tg4event_lib, input_file, output_file, options))
+                process.start()
+                sender.close()
+                try:
+                    report = receiver.recv()
+                except EOFError:
+                    report = None
+                finally:
+                    process.join()
+                if report is None or "error" in report:
+                    error = report["error"] if report else f"exit code {process.exitcode}"
+                    print(f"{eng:>8} {n:>5}  failed: {error}")
+                    continue
+                print(f"{eng:>8} {n:>5} {report['events_per_s']:10.1f} {report['segments_per_s']:12.1f} "
+                      f"{report['peak_memory_mb']:8.1f}")
+
+                if results:
+                    report.update(time=time.strftime("%Y-%m-%dT%H:%M:%S"), spills=spills,
+                                  events_per_spill=events_per_spill, trajectories=trajectories, points=points,
+                                  detectors=detectors, segments=segments, seed=seed, member_wise=member_wise)
+                    del report["input_file"]
+                    with open(results, 'a') as f:
+                        f.write(json.dumps(report) + '\n')
+
+if __name__ == "__main__":
+    fire.Fire(benchmark)
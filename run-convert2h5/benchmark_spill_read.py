@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+"""
+Benchmarks reading EDEPSIM_H5 files spill by spill, with and without
+spill-aligned chunks
+"""
+
+import os
+import time
+import tempfile
+import numpy as np
+import fire
+import h5py
+
+from convert_edepsim_roottoh5 import HDF5Writer, output_dtypes, outputDtypes
+
+# The [start, stop) rows of each spill (event_id) in a dataset
+def spillRegions(event_id):
+    if not len(event_id):
+        return np.empty((0, 2), dtype='i8')
+    starts = np.concatenate(([0], np.flatnonzero(event_id[1:] != event_id[:-1]) + 1))
+    return np.stack((starts, np.append(starts[1:], len(event_id))), axis=1)
+
+# Row boundaries of the chunks of a dataset: its pieces if it is virtual,
+# otherwise multiples of its chunk length
+def chunkBounds(dset):
+    if dset.is_virtual:
+        return np.cumsum([0] + [source.vspace.get_select_npoints() for source in dset.virtual_sources()])
+    return np.append(np.arange(0, len(dset), dset.chunks[0]), len(dset))
+
+# Number and rows of the chunks read for each [start, stop) region, from
+# chunkBounds
+def chunksRead(bounds, regions):
+    first = np.searchsorted(bounds, regions[:, 0], side='right') - 1
+    last = np.searchsorted(bounds, regions[:, 1] - 1, side='right') - 1
+    return last + 1 - first, bounds[last + 1] - bounds[first]
+
+# Rewrite the datasets of `data` with one layout (chunk_size, or spill-aligned
+# chunks of spill_chunk_bytes), then read them back one spill at a time.
+# Returns the file size, the mean time to read a spill (all datasets), the mean
+# number of chunks holding a spill of a dataset, and the read amplification:
+# rows of the chunks holding each spill / rows of the spill.
+def benchmarkLayout(data, path, compression, chunk_size, spill_chunk_bytes, block_rows):
+    dtypes = outputDtypes(dict(spill_index=False))
+    with HDF5Writer(path, chunk_size, compression=compression, dtypes=dtypes,
+                    spill_chunk_bytes=spill_chunk_bytes) as writer:
+        for name, rows in data.items():
+            for first in range(0, len(rows), block_rows):
+                writer.append(name, rows[first:first+block_rows])
+
+    with h5py.File(path, 'r') as f:
+        regions = {name: spillRegions(rows["event_id"]) for name, rows in data.items()}
+        spills = max(len(region) for region in regions.values())
+        chunks = [chunksRead(chunkBounds(f[name]), region) for name, region in regions.items()]
+        nchunks = sum(count.sum() for count, _ in chunks) / sum(len(region) for region in regions.values())
+        amplification = sum(rows.sum() for _, rows in chunks) / sum(len(rows) for rows in data.values())
+
+        start = time.perf_counter()
+        for name, region in regions.items():
+            dset = f[name]
+            for first, last in region.tolist():
+                dset[first:last]
+        read_time = time.perf_counter() - start
+
+    return os.path.getsize(path), read_time / spills, nchunks, amplification
+
+# Run the benchmark.
+def benchmark(input_file, compression="gzip", chunk_size=["auto", "small", "medium"],
+              spill_chunk_bytes=["small", "medium"], block_rows=100000, tmp_dir=None):
+
+    """
+    Rewrite the datasets of an EDEPSIM_H5 file with each chunk size preset, and
+    with spill-aligned chunks of each target size, and report the mean time to
+    read one spill of every dataset, how many chunks hold a spill of a dataset
+    (1 when chunks hold whole spills) and how many rows of chunks are read per
+    row of the spills. HDF5 reads and decompresses whole chunks, so a spill
+    straddling chunk boundaries costs the neighbouring data too.
+
+    Args:
+        input_file (str): sample EDEPSIM_H5 file, as written by convert_edepsim_roottoh5.py
+        compression (str): compression spec, as for convert_edepsim_roottoh5.py
+        chunk_size (list): chunk sizes, in rows or as presets, for the usual layout
+        spill_chunk_bytes (list): target chunk sizes, in bytes or as presets,
+            for the spill-aligned layout
+        block_rows (int): rows per append, standing in for the converter's flushes
+        tmp_dir (str): where to write the rewritten files. Default: system temp dir
+    """
+
+    with h5py.File(input_file, 'r') as f:
+        data = {name: f[name][:] for name in output_dtypes
+                if isinstance(f.get(name), h5py.Dataset) and len(f[name])}
+    nbytes = sum(rows.nbytes for rows in data.values())
+    print(f"{input_file}: {nbytes / 1e6:.1f} MB uncompressed in",
+          ", ".join(f"{name} ({len(rows)} rows)" for name, rows in data.items()))
+    print(f"{'layout':>20} {'size MB':>9} {'ms/spill':>9} {'chunks/spill':>12} {'rows read/row':>13}")
+
+    layouts = [(f"chunks {chunks}", chunks, None) for chunks in chunk_size] \
+        + [(f"spill-aligned {target}", None, target) for target in spill_chunk_bytes]
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        path = os.path.join(tmp, "benchmark.hdf5")
+        for label, chunks, target in layouts:
+            try:
+                size, spill_time, nchunks, amplification = benchmarkLayout(data, path, compression, chunks,
+                                                                           target, block_rows)
+            finally:
+                if os.path.exists(path):
+                    os.remove(path)
+            print(f"{label:>20} {size / 1e6:9.1f} {spill_time * 1e3:9.3f} {nchunks:12.2f} {amplification:13.2f}")
+
+if __name__ == "__main__":
+    fire.Fire(benchmark)
@@ -3,15 +3,22 @@
 Converts ROOT file created by edep-sim into HDF5 format
 """
 
-from math import sqrt
 import os
+import sys
+import traceback
+import json
+import time
+import threading
+import resource
+from contextlib import contextmanager
 import numpy as np
 import fire
 import h5py
 from tqdm import tqdm
 import glob
 
-from ROOT import TG4Event, TFile, TMap
+import ROOT
+from ROOT import TG4Event, TFile, TMap, gInterpreter
 
 # Output array datatypes
 segments_dtype = np.dtype([("event_id","u4"),("vertex_id", "u8"), ("segment_id", "u4"),
@@ -45,15 +52,24 @@ genie_stack_dtype = np.dtype([("event_id", "u4"), ("vertex_id", "u8"), ("traj_id
                               ("part_4mom", "f4", (4,)), ("part_pdg", "i4"),
                               ("part_status", "i4")], align=True)
 
-genie_hdr_dtype = np.dtype([("event_id", "u4"), ("vertex_id", "u8"),
-                            ("x_vert","f4"), ("y_vert","f4"), ("z_vert","f4"),
-                            ("t_vert","f8"), ("target", "u4"), ("reaction", "i4"),
-                            ("isCC", "?"), ("isQES", "?"), ("isMEC", "?"),
-                            ("isRES", "?"), ("isDIS", "?"), ("isCOH", "?"),
-                            ("Enu", "f4"), ("nu_4mom", "f4", (4,)), ("nu_pdg", "i4"),
-                            ("Elep", "f4"), ("lep_mom", "f4"), ("lep_ang", "f4"), ("lep_pdg", "i4"),
-                            ("q0", "f4"), ("q3", "f4"), ("Q2", "f4"),
-                            ("x", "f4"), ("y", "f4")], align=True)
+genie_hdr_fields = [("event_id", "u4"), ("vertex_id", "u8"),
+                    ("x_vert","f4"), ("y_vert","f4"), ("z_vert","f4"),
+                    ("t_vert","f8"), ("target", "u4"), ("reaction", "i4"),
+                    ("isCC", "?"), ("isQES", "?"), ("isMEC", "?"),
+                    ("isRES", "?"), ("isDIS", "?"), ("isCOH", "?"),
+                    ("Enu", "f4"), ("nu_4mom", "f4", (4,)), ("nu_pdg", "i4"),
+                    ("Elep", "f4"), ("lep_mom", "f4"), ("lep_ang", "f4"), ("lep_pdg", "i4"),
+                    ("q0", "f4"), ("q3", "f4"), ("Q2", "f4"),
+                    ("x", "f4"), ("y", "f4")]
+genie_hdr_dtype = np.dtype(genie_hdr_fields, align=True)
+
+# With evtcode_table, mc_hdr also holds the row of the event's EvtCode in the
+# mc_evtcode lookup table
+genie_hdr_evtcode_dtype = np.dtype(genie_hdr_fields + [("evt_code", "i4")], align=True)
+
+evtcode_dtype = np.dtype([("evt_code", "i4"), ("evt_str", h5py.string_dtype()), ("reaction", "i4"),
+                          ("isCC", "?"), ("isQES", "?"), ("isMEC", "?"),
+                          ("isRES", "?"), ("isDIS", "?"), ("isCOH", "?")], align=True)
 
 # Convert from EDepSim default units (mm, ns)
 edep2cm = 0.1   # convert to cm
@@ -66,7 +82,6 @@ meter2cm = 100  # convert to cm
 # Needed for event kinematics calculation
 nucleon_mass = 938.272 # MeV
 beam_dir  = np.asarray([0.0, -0.05836, 1.0]) # -3.34 degrees in the y-direction
-beam_norm = np.linalg.norm(beam_dir)
 
 # Print the fields in a TG4PrimaryParticle object
 def printPrimaryParticle(depth, primaryParticle):
@@ -156,28 +171,30 @@ def printSegmentContainer(depth, containerName, hitSegments):
     for hitSegment in hitSegments: printHitSegment(depth, hitSegment)
 
 # Match edep-sim trajectories with MC generator particles.
-# Objects are matched based on the PDG code and the momentum 4-vector.
-# If no match is found, return default value of -999
-def matchTrackID(traj_list, part_4mom, part_pdg):
-
-    traj_id = -999
-    file_traj_id = -999
-    for traj in traj_list:
-        if traj["parent_id"] != -1:
-            continue
-
-        if traj["pdg_id"] != part_pdg:
-            continue
-
-        p = traj["pxyz_start"]
-        E = traj["E_start"]
-        traj_4mom = np.array([p[0], p[1], p[2], E])
-
-        if np.allclose(traj_4mom, part_4mom):
-            traj_id = traj["traj_id"]
-            file_traj_id = traj["file_traj_id"]
-            break
-
+# Objects are matched based on the PDG code and the momentum 4-vector, for all
+# (n,) particles of an event at once: every particle is compared with the
+# (n_primaries, 4) matrix of primary trajectory (px, py, pz, E_start), using
+# np.isclose with tolerances rtol and atol, and takes the IDs of the first
+# trajectory that matches. If no match is found, return default value of -999
+def matchTrackIDs(trajectories, part_4mom, part_pdg, rtol=1e-05, atol=1e-08):
+    traj_id = np.full(len(part_pdg), -999, dtype='i8')
+    file_traj_id = np.full(len(part_pdg), -999, dtype='i8')
+
+    primaries = trajectories[trajectories["parent_id"] == -1]
+    if len(part_pdg) == 0 or len(primaries) == 0:
+        return traj_id, file_traj_id
+
+    traj_4mom = np.empty((len(primaries), 4), dtype='f4')
+    traj_4mom[:, :3] = primaries["pxyz_start"]
+    traj_4mom[:, 3] = primaries["E_start"]
+
+    match = (primaries["pdg_id"][np.newaxis, :] == np.asarray(part_pdg)[:, np.newaxis]) & \
+        np.isclose(traj_4mom[np.newaxis, :, :], np.asarray(part_4mom)[:, np.newaxis, :],
+                   rtol=rtol, atol=atol).all(axis=2)
+    matched = match.any(axis=1)
+    first = match.argmax(axis=1)[matched]
+    traj_id[matched] = primaries["traj_id"][first]
+    file_traj_id[matched] = primaries["file_traj_id"][first]
     return traj_id, file_traj_id
 
 #Map from GENIE reaction to number to match CAFs
@@ -220,144 +237,1648 @@ def getReactionCode(genie_str):
 
     return reaction
 
-# Prep HDF5 file for writing
-def initHDF5File(output_file):
-    with h5py.File(output_file, 'w') as f:
-        f.create_dataset('trajectories', (0,), dtype=trajectories_dtype, maxshape=(None,))
-        f.create_dataset('segments', (0,), dtype=segments_dtype, maxshape=(None,))
-        f.create_dataset('vertices', (0,), dtype=vertices_dtype, maxshape=(None,))
-        f.create_dataset('mc_stack', (0,), dtype=genie_stack_dtype, maxshape=(None,))
-        f.create_dataset('mc_hdr', (0,), dtype=genie_hdr_dtype, maxshape=(None,))
-
-# Resize HDF5 file and save output arrays
-def updateHDF5File(output_file, trajectories, segments, vertices, genie_s, genie_h):
-    if any([len(trajectories), len(segments), len(vertices), len(genie_s), len(genie_h)]):
-        with h5py.File(output_file, 'a') as f:
-            if len(trajectories):
-                ntraj = len(f['trajectories'])
-                f['trajectories'].resize((ntraj+len(trajectories),))
-                f['trajectories'][ntraj:] = trajectories
-
-            if len(segments):
-                nseg = len(f['segments'])
-                f['segments'].resize((nseg+len(segments),))
-                f['segments'][nseg:] = segments
-
-            if len(vertices):
-                nvert = len(f['vertices'])
-                f['vertices'].resize((nvert+len(vertices),))
-                f['vertices'][nvert:] = vertices
-
-            if len(genie_s):
-                ngenie_s = len(f['mc_stack'])
-                f['mc_stack'].resize((ngenie_s+len(genie_s),))
-                f['mc_stack'][ngenie_s:] = genie_s
-
-            if len(genie_h):
-                ngenie_h = len(f['mc_hdr'])
-                f['mc_hdr'].resize((ngenie_h+len(genie_h),))
-                f['mc_hdr'][ngenie_h:] = genie_h
-
-# Read a file and dump it.
-def dump(input_file, output_file, keep_all_dets=False):
-
-    """
-    Script to convert edep-sim root output to an h5 file formatted in a way
-    that larnd-sim expects for consumption.
-
-    Args:
-        input_file (str): path to an input ROOT file containing spills.
-        output_file (str): name of the h5 output file to which the information should
-            be written
-    """
-
-    # Prep output file
-    initHDF5File(output_file)
-
-    segment_id = 0
+# Substrings of the EvtCode string behind the isCC, isQES, ... flags
+evtcode_flags = ["CC", "QES", "MEC", "RES", "DIS", "COH"]
+
+# Classification of every distinct EvtCode string seen so far, as (reaction
+# code, one bool per evtcode_flags entry). A campaign has only a few hundred
+# distinct strings, so each is parsed once.
+evtcode_cache = dict()
+
+def classifyEvtCode(genie_str):
+    if genie_str not in evtcode_cache:
+        evtcode_cache[genie_str] = (getReactionCode(genie_str),) + tuple(flag in genie_str for flag in evtcode_flags)
+    return evtcode_cache[genie_str]
+
+# The mc_evtcode lookup table, from a dict of {EvtCode string: row} filled by
+# fillGenieHeaders
+def evtcodeTable(evtcodes):
+    table = np.empty(len(evtcodes), dtype=evtcode_dtype)
+    table["evt_code"] = list(evtcodes.values())
+    table["evt_str"] = list(evtcodes.keys())
+    classes = np.array([classifyEvtCode(code) for code in evtcodes], dtype='i4').reshape(-1, 1 + len(evtcode_flags))
+    table["reaction"] = classes[:, 0]
+    for i, flag in enumerate(evtcode_flags):
+        table["is" + flag] = classes[:, i+1]
+    return table
+
+# C++ helpers that copy edep-sim objects into flat std::vector<double>s, so the
+# PyROOT engine needs one call per container instead of one per getter, and
+# the bulk engine one per block of entries. Declared on first use.
+root_helpers_declared = False
+
+def declareROOTHelpers():
+    global root_helpers_declared
+    if root_helpers_declared:
+        return
+
+    gInterpreter.Declare("""
+    #pragma cling optimize(3)
+    #include <sstream>
+    #include "TMap.h"
+    #include "TObjString.h"
+    #include "TTree.h"
+
+    // Per hit: start x, y, z, t, stop x, y, z, t, energy deposit, first contributor
+    std::vector<double> convert2h5_packHitSegments(const std::vector<TG4HitSegment>& hits) {
+        std::vector<double> out;
+        out.reserve(10*hits.size());
+        for (const auto& hit : hits) {
+            out.insert(out.end(), {hit.Start.X(), hit.Start.Y(), hit.Start.Z(), hit.Start.T(),
+                                   hit.Stop.X(), hit.Stop.Y(), hit.Stop.Z(), hit.Stop.T(),
+                                   hit.EnergyDeposit,
+                                   hit.Contrib.empty() ? -1. : double(hit.Contrib[0])});
+        }
+        return out;
+    }
+
+    // Per trajectory: track id, parent id, PDG code
+    std::vector<int> convert2h5_packTrajectoryTable(const std::vector<TG4Trajectory>& trajs) {
+        std::vector<int> out;
+        out.reserve(3*trajs.size());
+        for (const auto& traj : trajs) {
+            out.insert(out.end(), {traj.TrackId, traj.ParentId, traj.PDGCode});
+        }
+        return out;
+    }
+
+    // Per selected trajectory: track id, parent id, PDG code, initial
+    // momentum x, y, z, E, number of points
+    std::vector<double> convert2h5_packTrajectories(const std::vector<TG4Trajectory>& trajs,
+                                                    const std::vector<int>& select) {
+        std::vector<double> out;
+        out.reserve(8*select.size());
+        for (int i : select) {
+            const auto& traj = trajs[i];
+            out.insert(out.end(), {double(traj.TrackId), double(traj.ParentId), double(traj.PDGCode),
+                                   traj.InitialMomentum.X(), traj.InitialMomentum.Y(),
+                                   traj.InitialMomentum.Z(), traj.InitialMomentum.E(),
+                                   double(traj.Points.size())});
+        }
+        return out;
+    }
+
+    // Per point of the selected trajectories: position x, y, z, t, momentum
+    // x, y, z, process, subprocess
+    std::vector<double> convert2h5_packTrajectoryPoints(const std::vector<TG4Trajectory>& trajs,
+                                                        const std::vector<int>& select) {
+        std::vector<double> out;
+        for (int i : select) {
+            for (const auto& pt : trajs[i].Points) {
+                out.insert(out.end(), {pt.Position.X(), pt.Position.Y(), pt.Position.Z(), pt.Position.T(),
+                                       pt.Momentum.X(), pt.Momentum.Y(), pt.Momentum.Z(),
+                                       double(pt.Process), double(pt.Subprocess)});
+            }
+        }
+        return out;
+    }
+
+    // Per event_spill_map entry: run id, event id, spill id, parsed from the
+    // "run event" key and "spill" value strings
+    std::vector<long long> convert2h5_packSpillMap(const TMap& map) {
+        std::vector<long long> out;
+        out.reserve(3*map.GetSize());
+        TIter next(&map);
+        while (TObject* key = next()) {
+            long long run_id = 0, event_id = 0;
+            std::istringstream(key->GetName()) >> run_id >> event_id;
+            out.insert(out.end(), {run_id, event_id, std::stoll(map.GetValue(key)->GetName())});
+        }
+        return out;
+    }
+
+    // gRooTracker entries [first, last). Per entry: number of particles and
+    // vertex x, y, z, t, plus the EvtCode string; per particle: status, PDG
+    // code, momentum x, y, z, E. Only these branches are read.
+    void convert2h5_packGenie(TTree* tree, Long64_t first, Long64_t last, std::vector<double>& entries,
+                              std::vector<double>& particles, std::vector<std::string>& codes) {
+        const int maxp = 4000; // kNPmax of gRooTracker
+        int n = 0;
+        std::vector<int> status(maxp), pdg(maxp);
+        std::vector<double> p4(4*maxp), vtx(4);
+        TObjString* code = nullptr;
+        tree->SetBranchStatus("*", false);
+        for (const char* name : {"StdHepN", "StdHepStatus", "StdHepPdg", "StdHepP4", "EvtVtx", "EvtCode"}) {
+            tree->SetBranchStatus(name, true);
+        }
+        // EvtCode may be a split TObjString, whose sub-branches (fString...)
+        // don't follow its status
+        for (TObject* branch : *tree->GetBranch("EvtCode")->GetListOfBranches()) {
+            tree->SetBranchStatus(branch->GetName(), true);
+        }
+        tree->SetBranchAddress("StdHepN", &n);
+        tree->SetBranchAddress("StdHepStatus", status.data());
+        tree->SetBranchAddress("StdHepPdg", pdg.data());
+        tree->SetBranchAddress("StdHepP4", p4.data());
+        tree->SetBranchAddress("EvtVtx", vtx.data());
+        tree->SetBranchAddress("EvtCode", &code);
+        for (Long64_t i = first; i < last; ++i) {
+            tree->GetEntry(i);
+            entries.insert(entries.end(), {double(n), vtx[0], vtx[1], vtx[2], vtx[3]});
+            for (int p = 0; p < n; ++p) {
+                particles.insert(particles.end(), {double(status[p]), double(pdg[p]),
+                                                   p4[4*p], p4[4*p+1], p4[4*p+2], p4[4*p+3]});
+            }
+            codes.push_back(code ? code->GetString().Data() : "");
+        }
+        tree->ResetBranchAddresses();
+        tree->SetBranchStatus("*", true);
+        delete code;
+    }
+
+    // EDepSimEvents entries [first, last), as flat tables. Per entry: run id,
+    // event id and number of vertices, trajectories and containers; per
+    // vertex: position x, y, z, t; per trajectory: track id, parent id, PDG
+    // code and number of points, plus (with `points`) its initial momentum
+    // x, y, z, E and points as in convert2h5_packTrajectoryPoints; per
+    // container: its name and number of hits, and the hits as in
+    // convert2h5_packHitSegments. An entry that can't be read has none.
+    struct Convert2h5Events {
+        std::vector<long long> entries, trajectories, containers;
+        std::vector<double> vertices, init_mom, points, hits;
+        std::vector<std::string> names;
+    };
+
+    void convert2h5_packEvents(TTree* tree, Long64_t first, Long64_t last, bool points, Convert2h5Events& out) {
+        TG4Event* event = nullptr;
+        tree->SetBranchAddress("Event", &event);
+        for (Long64_t i = first; i < last; ++i) {
+            const bool read = tree->GetEntry(i) > 0;
+            const auto& primaries = event->Primaries;
+            const auto& trajs = event->Trajectories;
+            const auto& dets = event->SegmentDetectors;
+            out.entries.insert(out.entries.end(), {(long long)event->RunId, (long long)event->EventId,
+                                                   read ? (long long)primaries.size() : 0,
+                                                   read ? (long long)trajs.size() : 0,
+                                                   read ? (long long)dets.size() : 0});
+            if (!read) {
+                continue;
+            }
+            for (const auto& vtx : primaries) {
+                out.vertices.insert(out.vertices.end(), {vtx.Position.X(), vtx.Position.Y(),
+                                                         vtx.Position.Z(), vtx.Position.T()});
+            }
+            for (const auto& traj : trajs) {
+                out.trajectories.insert(out.trajectories.end(), {(long long)traj.TrackId, (long long)traj.ParentId,
+                                                                 (long long)traj.PDGCode,
+                                                                 (long long)traj.Points.size()});
+                if (!points) {
+                    continue;
+                }
+                out.init_mom.insert(out.init_mom.end(), {traj.InitialMomentum.X(), traj.InitialMomentum.Y(),
+                                                         traj.InitialMomentum.Z(), traj.InitialMomentum.E()});
+                for (const auto& pt : traj.Points) {
+                    out.points.insert(out.points.end(), {pt.Position.X(), pt.Position.Y(), pt.Position.Z(),
+                                                         pt.Position.T(), pt.Momentum.X(), pt.Momentum.Y(),
+                                                         pt.Momentum.Z(), double(pt.Process), double(pt.Subprocess)});
+                }
+            }
+            for (const auto& det : dets) {
+                out.names.push_back(det.first);
+                out.containers.push_back(det.second.size());
+                for (const auto& hit : det.second) {
+                    out.hits.insert(out.hits.end(), {hit.Start.X(), hit.Start.Y(), hit.Start.Z(), hit.Start.T(),
+                                                     hit.Stop.X(), hit.Stop.Y(), hit.Stop.Z(), hit.Stop.T(),
+                                                     hit.EnergyDeposit,
+                                                     hit.Contrib.empty() ? -1. : double(hit.Contrib[0])});
+                }
+            }
+        }
+        tree->ResetBranchAddresses();
+        delete event;
+    }
+    """)
+    # Let the other threads of a pipeline run while a block is read
+    ROOT.convert2h5_packEvents.__release_gil__ = True
+    ROOT.convert2h5_packGenie.__release_gil__ = True
+    root_helpers_declared = True
+
+# Copy one SegmentDetectors container into (n, 4) start and stop arrays, plus
+# energy deposit and first contributor arrays
+def packHitSegments(hitSegments):
+    declareROOTHelpers()
+    hits = np.array(ROOT.convert2h5_packHitSegments(hitSegments), dtype='f8').reshape(-1, 10)
+    return hits[:, 0:4], hits[:, 4:8], hits[:, 8], hits[:, 9].astype('i8')
+
+# Unique-in-file track IDs and PDG codes of the first contributors of
+# segments, from the event's track id -> file_traj_id and track id -> PDG code
+# maps. Segments without a contributor (-1) or whose contributor is not among
+# the event's trajectories get the traj_id fill value and PDG code 0.
+def contributorIDs(contrib, trackMap, trackPdg):
+    missing = np.iinfo(segments_dtype['file_traj_id']).max
+    contrib = contrib.tolist()
+    return np.array([trackMap.get(seg_traj_id, missing) for seg_traj_id in contrib], dtype='i8'), \
+        np.array([trackPdg.get(seg_traj_id, 0) for seg_traj_id in contrib], dtype='i8')
+
+# Copy the (track id, parent id, PDG code) table of an event's trajectories
+# into arrays
+def packTrajectoryTable(trajectories):
+    declareROOTHelpers()
+    table = np.array(ROOT.convert2h5_packTrajectoryTable(trajectories), dtype='i8').reshape(-1, 3)
+    return table[:, 0], table[:, 1], table[:, 2]
+
+# Copy the trajectories at positions `select` of an event into the packed
+# arrays taken by fillTrajectories
+def packTrajectories(trajectories, select):
+    declareROOTHelpers()
+    select = [int(i) for i in select]
+    header = np.array(ROOT.convert2h5_packTrajectories(trajectories, select), dtype='f8').reshape(-1, 8)
+    points = np.array(ROOT.convert2h5_packTrajectoryPoints(trajectories, select), dtype='f8').reshape(-1, 9)
+    point_offsets = np.zeros(len(header)+1, dtype='i8')
+    np.cumsum(header[:, 7].astype('i8'), out=point_offsets[1:])
+    return (header[:, 0].astype('i8'), header[:, 1].astype('i8'), header[:, 2].astype('i8'), header[:, 3:7],
+            point_offsets, points[:, 0:4], points[:, 4:7], points[:, 7].astype('i8'), points[:, 8].astype('i8'))
+
+# Read gRooTracker entries [entry_start, entry_stop) into flat arrays, with
+# the same keys as the GENIE part of a readBlocksROOT block
+def readGenieROOT(genieTree, entry_start, entry_stop):
+    declareROOTHelpers()
+    entries, particles = ROOT.std.vector('double')(), ROOT.std.vector('double')()
+    codes = ROOT.std.vector('std::string')()
+    ROOT.convert2h5_packGenie(genieTree, entry_start, entry_stop, entries, particles, codes)
+    entries = np.array(entries, dtype='f8').reshape(-1, 5)
+    particles = np.array(particles, dtype='f8').reshape(-1, 6)
+    genie_offsets = np.zeros(len(entries)+1, dtype='i8')
+    np.cumsum(entries[:, 0].astype('i8'), out=genie_offsets[1:])
+    return dict(genie_offsets=genie_offsets,
+                stdhep_status=particles[:, 0].astype('i8'),
+                stdhep_pdg=particles[:, 1].astype('i8'),
+                stdhep_p4=particles[:, 2:6],
+                evt_vtx=entries[:, 1:5],
+                evt_code=np.array([str(code) for code in codes], dtype=object))
+
+# Numeric key of a (run id, event id) pair in a spill map. It is only unique
+# for 32-bit run ids and unsigned 32-bit event ids, so others are refused.
+def spillMapKey(run_ids, event_ids):
+    run_ids, event_ids = np.asarray(run_ids, dtype='i8'), np.asarray(event_ids, dtype='i8')
+    bad = np.flatnonzero((run_ids < -2**31) | (run_ids >= 2**31) | (event_ids < 0) | (event_ids >= 2**32))
+    if len(bad):
+        raise ValueError(f"Event {run_ids.flat[bad[0]]} {event_ids.flat[bad[0]]} has a run or event id "
+                         "out of the range event_spill_map lookups support")
+    return run_ids * 2**32 + event_ids
+
+# Extract a whole event_spill_map TMap ("run event" -> "spill" strings) in one
+# go, as an array of keys (see spillMapKey) sorted for lookupSpills, and the
+# spill id of each
+def readSpillMap(event_spill_map):
+    declareROOTHelpers()
+    table = np.array(ROOT.convert2h5_packSpillMap(event_spill_map), dtype='i8').reshape(-1, 3)
+    keys = spillMapKey(table[:, 0], table[:, 1])
+    order = np.argsort(keys)
+    return keys[order], table[order, 2]
+
+# Spill id of each (run id, event id) pair, from a map made by readSpillMap
+def lookupSpills(spill_map, run_ids, event_ids):
+    keys, spills = spill_map
+    query = spillMapKey(run_ids, event_ids)
+    idx = np.minimum(np.searchsorted(keys, query), max(len(keys)-1, 0))
+    missing = np.nonzero(keys[idx] != query)[0] if len(keys) else np.arange(len(query))
+    if len(missing):
+        raise KeyError(f"Event {run_ids[missing[0]]} {event_ids[missing[0]]} not in event_spill_map")
+    return spills[idx]
+
+# Spill counter of each entry, given the spill id of each: incremented
+# whenever the spill changes, carrying on from state["spillCounter"] and
+# state["lastSpill"], which are updated to the last entry
+def countSpills(spills, state):
+    if len(spills) == 0:
+        return np.empty((0,), dtype='i8')
+    new_spill = np.empty(len(spills), dtype=bool)
+    new_spill[0] = spills[0] != state["lastSpill"]
+    new_spill[1:] = spills[1:] != spills[:-1]
+    counters = state["spillCounter"] + np.cumsum(new_spill)
+    state["spillCounter"], state["lastSpill"] = int(counters[-1]), int(spills[-1])
+    return counters
+
+# Read the RunId and EventId of entries [entry_start, entry_stop), without
+# reading the rest of the events
+def readEventIds(inputTree, entry_start, entry_stop):
+    nentries = entry_stop - entry_start
+    if nentries <= 0:
+        return np.empty((0,), dtype='i8'), np.empty((0,), dtype='i8')
+    inputTree.SetEstimate(nentries + 1)
+    inputTree.Draw("RunId:EventId", "", "goff", nentries, entry_start)
+    run_ids, event_ids = inputTree.GetV1(), inputTree.GetV2()
+    run_ids.reshape((nentries,))
+    event_ids.reshape((nentries,))
+    return np.array(run_ids, dtype='f8').astype('i8'), np.array(event_ids, dtype='f8').astype('i8')
+
+# Work out which trajectories of an event to store: the primaries, plus the
+# full ancestry of every segment contributor. Returns positions in the event's
+# (track_ids, parent_ids) table in the order the rows are written: primaries
+# first, then for each new contributor (in segment order) its not yet stored
+# ancestors, from the contributor up. Each trajectory is visited at most once,
+# since once a trajectory is stored all of its ancestors are too. Contributors
+# and parents that are not in the table are skipped.
+def resolveAncestry(track_ids, parent_ids, contribs):
+    position = {track_id: i for i, track_id in enumerate(track_ids.tolist())}
+    parents = parent_ids.tolist()
+
+    order = np.nonzero(parent_ids == -1)[0].tolist()
+    stored = np.zeros(len(track_ids), dtype=bool)
+    stored[order] = True
+
+    for contrib in dict.fromkeys(contribs.tolist()):
+        i = position.get(contrib)
+        while i is not None and not stored[i]:
+            stored[i] = True
+            order.append(i)
+            if parents[i] == -1:
+                break
+            i = position.get(parents[i])
+
+    return np.array(order, dtype='i8')
+
+# Fill the kinematic fields of a trajectories_dtype array from packed
+# trajectories: (n,) track id, parent id and PDG code arrays, (n, 4) initial
+# momenta (x, y, z, E), and the points of all trajectories as (n_points, 4)
+# positions (x, y, z, t), (n_points, 3) momenta and process/subprocess arrays,
+# where the points of trajectory i are [point_offsets[i], point_offsets[i+1]).
+# Every trajectory needs at least one point. The event_id, vertex_id and
+# file_traj_id fields are left for the caller.
+def fillTrajectories(track_ids, parent_ids, pdg, init_mom,
+                     point_offsets, point_pos, point_mom, point_process, point_subprocess):
+    traj = np.empty(len(track_ids), dtype=trajectories_dtype)
+    if len(traj) == 0:
+        return traj
+    first, last = point_offsets[:-1], point_offsets[1:] - 1
+
+    traj["traj_id"] = track_ids
+    traj["parent_id"] = parent_ids
+    traj["primary"] = parent_ids == -1 # primary particle parents trajectory id are -1
+    traj["pdg_id"] = pdg
+
+    # Same arithmetic as TLorentzVector::M(), squared
+    px, py, pz, E = init_mom[:, 0], init_mom[:, 1], init_mom[:, 2], init_mom[:, 3]
+    mass2 = np.sqrt(np.abs(E*E - (px*px + py*py + pz*pz)))**2
+    p_start, p_end = point_mom[first], point_mom[last]
+
+    traj["pxyz_start"] = p_start
+    traj["pxyz_end"] = p_end
+    traj["xyz_start"] = point_pos[first, :3] * edep2cm
+    traj["xyz_end"] = point_pos[last, :3] * edep2cm
+    traj["E_start"] = np.sqrt(np.sum(np.square(p_start), axis=1) + mass2)
+    traj["E_end"] = np.sqrt(np.sum(np.square(p_end), axis=1) + mass2)
+    traj["t_start"] = point_pos[first, 3] * edep2us
+    traj["t_end"] = point_pos[last, 3] * edep2us
+    traj["start_process"] = point_process[first]
+    traj["start_subprocess"] = point_subprocess[first]
+    traj["end_process"] = point_process[last]
+    traj["end_subprocess"] = point_subprocess[last]
+
+    # Length of the step from each point to the next one of the same
+    # trajectory, summed per trajectory
+    d = point_pos[1:, :3] - point_pos[:-1, :3]
+    step = np.zeros(len(point_pos))
+    step[:-1] = np.sqrt(d[:, 0]*d[:, 0] + d[:, 1]*d[:, 1] + d[:, 2]*d[:, 2]) * edep2cm
+    step[last] = 0
+    traj["dist_travel"] = np.add.reduceat(step, first)
+    return traj
+
+# Fill the kinematic fields of a segments_dtype array from the hit segments of a
+# container (or of a whole block), given as (n, 4) start and stop arrays of x,
+# y, z, t in edep-sim units (mm, ns) and an (n,) array of energy deposits. The
+# ID fields are left for the caller, the larnd-sim placeholders are zero.
+def fillSegments(start, stop, energy):
+    segment = np.zeros(len(energy), dtype=segments_dtype)
+    segment["x_start"] = start[:, 0] * edep2cm
+    segment["y_start"] = start[:, 1] * edep2cm
+    segment["z_start"] = start[:, 2] * edep2cm
+    segment["t0_start"] = start[:, 3] * edep2us
+    segment["x_end"] = stop[:, 0] * edep2cm
+    segment["y_end"] = stop[:, 1] * edep2cm
+    segment["z_end"] = stop[:, 2] * edep2cm
+    segment["t0_end"] = stop[:, 3] * edep2us
+    segment["dE"] = energy
+
+    # Differences of the float32 endpoints, summed in float64
+    xd = (segment["x_end"] - segment["x_start"]).astype('f8')
+    yd = (segment["y_end"] - segment["y_start"]).astype('f8')
+    zd = (segment["z_end"] - segment["z_start"]).astype('f8')
+    dx = np.sqrt(xd**2 + yd**2 + zd**2)
+    segment["dx"] = dx
+    segment["x"] = (segment["x_start"] + segment["x_end"]) / 2.
+    segment["y"] = (segment["y_start"] + segment["y_end"]) / 2.
+    segment["z"] = (segment["z_start"] + segment["z_end"]) / 2.
+    segment["t0"] = (segment["t0_start"] + segment["t0_end"]) / 2.
+    segment["dEdx"] = np.divide(energy, dx, out=np.zeros(len(dx)), where=dx > 0)
+    return segment
+
+# Rules for dropping hit segments during conversion, in the order they are
+# checked: dE below min_dE (MeV), midpoint outside every box of region
+# ([[xmin, xmax], [ymin, ymax], [zmin, zmax]] in cm), t0 outside t0_window
+# ([min, max) in us from the start of the spill)
+prune_rules = ["min_dE", "region", "t0_window"]
+
+# segment_pruning rows: per spill, the number and energy of the segments each
+# rule dropped, and of those kept
+segment_pruning_dtype = np.dtype([("event_id", "u4")]
+                                 + [(rule, [("segments", "u8"), ("dE", "f8")]) for rule in prune_rules + ["kept"]],
+                                 align=True)
+
+# For hit segments given as for fillSegments, the index in prune_rules of the
+# first rule of `prune` ({rule: parameter}) that drops each one, or
+# len(prune_rules) if it is kept
+def pruneRule(start, stop, energy, prune):
+    rule = np.full(len(energy), len(prune_rules), dtype='i1')
+    # Checked last to first, so that the first rule dropping a segment wins
+    if prune.get("t0_window") is not None:
+        t0 = (start[:, 3] + stop[:, 3]) / 2. * edep2us
+        rule[(t0 < prune["t0_window"][0]) | (t0 >= prune["t0_window"][1])] = prune_rules.index("t0_window")
+    if prune.get("region") is not None:
+        mid = (start[:, :3] + stop[:, :3]) / 2. * edep2cm
+        inside = np.zeros(len(energy), dtype=bool)
+        for box in np.asarray(prune["region"]):
+            inside |= ((mid >= box[:, 0]) & (mid < box[:, 1])).all(axis=1)
+        rule[~inside] = prune_rules.index("region")
+    if prune.get("min_dE") is not None:
+        rule[energy < prune["min_dE"]] = prune_rules.index("min_dE")
+    return rule
+
+# segment_pruning row of one event, from the pruneRule and energy arrays of
+# its segment containers
+def pruningRow(rules, energies, spill_it):
+    rule = np.concatenate(rules) if rules else np.empty((0,), dtype='i1')
+    energy = np.concatenate(energies) if energies else np.empty((0,), dtype='f8')
+    row = np.zeros(1, dtype=segment_pruning_dtype)
+    row["event_id"] = spill_it
+    counts = np.bincount(rule, minlength=len(prune_rules) + 1)
+    sums = np.bincount(rule, weights=energy, minlength=len(prune_rules) + 1)
+    for i, name in enumerate(prune_rules + ["kept"]):
+        row[name]["segments"] = counts[i]
+        row[name]["dE"] = sums[i]
+    return row
+
+# Euclidean norm of each row of an (n, 3) array, rounded exactly as
+# np.linalg.norm of each row on its own
+def rowNorm(v):
+    return np.sqrt((v[:, np.newaxis, :] @ v[:, :, np.newaxis])[:, 0, 0])
+
+# Index of the last particle of each of n entries for which mask is set, or -1,
+# given the entry of each particle
+def lastParticle(mask, entry, n):
+    last = np.full(n, -1, dtype='i8')
+    np.maximum.at(last, entry[mask], np.nonzero(mask)[0])
+    return last
+
+# Fill a genie_hdr_dtype array for a whole block of gRooTracker entries, from
+# the GENIE part of a block (see readBlocksROOT or readGenieROOT). The
+# neutrino is the last initial state (status 0) neutrino of an entry, the
+# target the last other initial state particle and the lepton the last final
+# state (status 1) lepton; their fields are zero if an entry has none. The
+# lepton angle is measured from beam_dir. The derived kinematics are rounded to
+# float32 at the same steps as the per-event calculation used to be.
+# If evtcodes is a dict, EvtCode strings not in it yet are added in order of
+# first appearance, numbered from len(evtcodes), and the evt_code field of
+# genie_hdr_evtcode_dtype is filled. event_id and vertex_id are left for the
+# caller.
+def fillGenieHeaders(genie, beam_dir, evtcodes=None):
+    offsets = genie["genie_offsets"]
+    n = len(offsets) - 1
+    entry = np.repeat(np.arange(n), np.diff(offsets))
+    status, pdg = genie["stdhep_status"], genie["stdhep_pdg"]
+    p4 = genie["stdhep_p4"] * gev2mev
+    is_nu = np.isin(np.abs(pdg), [12, 14, 16])
+
+    nu_4mom, lep_4mom = np.zeros((n, 4)), np.zeros((n, 4))
+    nu_pdg, lep_pdg, target_pdg = np.zeros(n, dtype='i8'), np.zeros(n, dtype='i8'), np.zeros(n, dtype='i8')
+    for mask, mom, part_pdg in (((status == 0) & is_nu, nu_4mom, nu_pdg),
+                                ((status == 1) & np.isin(np.abs(pdg), [11, 12, 13, 14, 15, 16]), lep_4mom, lep_pdg),
+                                ((status == 0) & ~is_nu, None, target_pdg)):
+        last = lastParticle(mask, entry, n)
+        found = last >= 0
+        if mom is not None:
+            mom[found] = p4[last[found]]
+        part_pdg[found] = pdg[last[found]]
+
+    genie_hdr = np.empty(n, dtype=genie_hdr_dtype if evtcodes is None else genie_hdr_evtcode_dtype)
+
+    # Classify each distinct EvtCode string of the block once
+    codes, first, code_idx = np.unique(genie["evt_code"].astype(str), return_index=True, return_inverse=True)
+    classes = np.array([classifyEvtCode(code) for code in codes], dtype='i4').reshape(-1, 1 + len(evtcode_flags))
+    genie_hdr["reaction"] = classes[code_idx, 0]
+    for i, flag in enumerate(evtcode_flags):
+        genie_hdr["is" + flag] = classes[code_idx, i+1]
+    if evtcodes is not None:
+        for i in np.argsort(first):
+            evtcodes.setdefault(codes[i], len(evtcodes))
+        genie_hdr["evt_code"] = np.array([evtcodes[code] for code in codes], dtype='i4')[code_idx]
+
+    genie_hdr["x_vert"] = genie["evt_vtx"][:, 0]*meter2cm
+    genie_hdr["y_vert"] = genie["evt_vtx"][:, 1]*meter2cm
+    genie_hdr["z_vert"] = genie["evt_vtx"][:, 2]*meter2cm
+    genie_hdr["t_vert"] = genie["evt_vtx"][:, 3]*edep2us
+    genie_hdr["target"] = ((target_pdg % 10000000) / 10000).astype('i8') #Extract Z value from PDG code
+    genie_hdr["Enu"] = nu_4mom[:, 3]
+    genie_hdr["nu_4mom"] = nu_4mom
+    genie_hdr["nu_pdg"] = nu_pdg
+    genie_hdr["Elep"] = lep_4mom[:, 3]
+    genie_hdr["lep_mom"] = rowNorm(lep_4mom[:, 0:3])
+    genie_hdr["lep_ang"] = np.arccos((lep_4mom[:, 0:3] @ beam_dir).astype('f4') /
+                                     (np.float32(np.linalg.norm(beam_dir)) * genie_hdr["lep_mom"])) \
+                           * np.float32(180.0 / np.pi) # degrees
+    genie_hdr["lep_pdg"] = lep_pdg
+    genie_hdr["q0"] = nu_4mom[:, 3] - lep_4mom[:, 3]
+    genie_hdr["q3"] = rowNorm(nu_4mom[:, 0:3] - lep_4mom[:, 0:3])
+    genie_hdr["Q2"] = genie_hdr["q3"]**2 - genie_hdr["q0"]**2
+    genie_hdr["x"]  = genie_hdr["Q2"] / (2.0 * nucleon_mass * genie_hdr["q0"])
+    genie_hdr["y"]  = 1.0 - (genie_hdr["Elep"] / genie_hdr["Enu"])
+    return genie_hdr
+
+# Fill the genie_stack_dtype rows of one gRooTracker entry, given the (n,)
+# status and PDG code arrays and (n, 4) momenta (in GeV) of its particles:
+# the initial and final state particles, matched to the event's trajectories
+# (see matchTrackIDs). event_id and vertex_id are left for the caller.
+def fillGenieStack(status, pdg, p4, trajectories, options):
+    stack = (status == 0) | (status == 1)
+    part_4mom = p4[stack] * gev2mev
+    genie_stack = np.empty(np.count_nonzero(stack), dtype=genie_stack_dtype)
+    genie_stack["traj_id"], genie_stack["file_traj_id"] = matchTrackIDs(
+        trajectories, part_4mom, pdg[stack], options["match_rtol"], options["match_atol"])
+    genie_stack["part_4mom"] = part_4mom
+    genie_stack["part_pdg"] = pdg[stack]
+    genie_stack["part_status"] = status[stack]
+    return genie_stack
+
+# Output datasets, in the order they are created
+output_dtypes = {"trajectories": trajectories_dtype, "segments": segments_dtype,
+                 "vertices": vertices_dtype, "mc_stack": genie_stack_dtype,
+                 "mc_hdr": genie_hdr_dtype}
+
+# Rows [start, stop) of a dataset, as in ndlar_flow's ref_region
+region_dtype = np.dtype([("start", "i8"), ("stop", "i8")])
+
+# spill_index rows: the rows of each spill (event_id) in each of the given
+# output datasets
+def spillIndexDtype(names):
+    return np.dtype([("event_id", "u4")] + [(name, region_dtype) for name in names], align=True)
+
+spill_index_dtype = spillIndexDtype(output_dtypes)
+
+# Ancestry index rows: per trajectories row, the row of its parent (-1 for
+# primaries and unknown parents) and the rows [start, stop) of traj_children
+# holding the rows of its children; per segments row, the row of its
+# contributing trajectory (-1 if it has none)
+traj_index_dtype = np.dtype([("parent_row", "i8"), ("children", region_dtype)], align=True)
+traj_children_dtype = np.dtype([("traj_row", "i8")])
+segment_index_dtype = np.dtype([("traj_row", "i8")])
+
+# segment_containers rows: the segments of one container (detector) of an
+# event, with their first segment_id and their rows [start, stop) in
+# segments/<detector>
+segment_containers_dtype = np.dtype([("event_id", "u4"), ("vertex_id", "u8"), ("detector", "S64"),
+                                     ("first_segment_id", "u4"), ("rows", region_dtype)], align=True)
+
+# segment_containers row for the n segments of one container of an event;
+# its rows count from 0 until HDF5Writer.routeSegments() places them. A
+# container name too long for the detector field is refused rather than cut,
+# which could merge containers.
+def containerRow(spill_it, vertex_id, detector, first_segment_id, n):
+    if len(detector.encode()) > segment_containers_dtype["detector"].itemsize:
+        raise ValueError(f"Segment container name {detector} is longer than the "
+                         f"{segment_containers_dtype['detector'].itemsize} bytes segment_containers holds")
+    row = np.zeros(1, dtype=segment_containers_dtype)
+    row["event_id"] = spill_it
+    row["vertex_id"] = vertex_id
+    row["detector"] = detector
+    row["first_segment_id"] = first_segment_id
+    row["rows"]["stop"] = n
+    return row
+
+# Rows among the trajectories of a batch of whole events of the trajectories
+# with the given vertex_id and track id, -1 where there is no such trajectory
+def trajectoryRows(trajectories, vertex_id, track_id):
+    vertex_ids = np.unique(trajectories["vertex_id"])
+    keys = (np.searchsorted(vertex_ids, trajectories["vertex_id"]).astype('i8') << 32) \
+        | trajectories["traj_id"].astype('i8')
+    order = np.argsort(keys, kind='stable')
+    wanted = (np.searchsorted(vertex_ids, vertex_id).astype('i8') << 32) | track_id.astype('i8')
+    if len(keys) == 0:
+        return np.full(len(wanted), -1, dtype='i8')
+    found = np.minimum(np.searchsorted(keys[order], wanted), len(keys) - 1)
+    return np.where(keys[order][found] == wanted, order[found], -1)
+
+# Ancestry index of a batch of whole events (see traj_index_dtype), whose
+# trajectories and traj_children start at rows traj_first and children_first
+# of the output. Returns the traj_index and traj_children rows.
+def ancestryIndex(trajectories, traj_first, children_first):
+    has_parent = trajectories["parent_id"] >= 0
+    parent = np.full(len(trajectories), -1, dtype='i8')
+    parent[has_parent] = trajectoryRows(trajectories, trajectories["vertex_id"][has_parent],
+                                        trajectories["parent_id"][has_parent])
+    has_parent = parent >= 0
+
+    # Children grouped by parent, in row order
+    children = np.flatnonzero(has_parent)
+    children = children[np.argsort(parent[children], kind='stable')]
+    counts = np.bincount(parent[has_parent], minlength=len(trajectories))
+    stops = np.cumsum(counts)
+
+    traj_index = np.empty(len(trajectories), dtype=traj_index_dtype)
+    traj_index["parent_row"] = np.where(has_parent, parent + traj_first, -1)
+    traj_index["children"]["start"] = stops - counts + children_first
+    traj_index["children"]["stop"] = stops + children_first
+    traj_children = np.empty(len(children), dtype=traj_children_dtype)
+    traj_children["traj_row"] = children + traj_first
+    return traj_index, traj_children
+
+# segment_index rows of the segments of a batch of whole events, whose
+# trajectories start at row traj_first of the output
+def segmentIndex(trajectories, segments, traj_first):
+    segment_index = np.empty(len(segments), dtype=segment_index_dtype)
+    if len(segments):
+        traj_row = trajectoryRows(trajectories, segments["vertex_id"], segments["traj_id"])
+        segment_index["traj_row"] = np.where(traj_row >= 0, traj_row + traj_first, -1)
+    return segment_index
+
+# Segment fields only reserved for larnd-sim (always zero here), left out of
+# the packed layout
+segments_placeholders = ["t_start", "t_end", "t", "n_electrons", "long_diff", "tran_diff",
+                         "pixel_plane", "n_photons"]
+
+# Packed layout of a dtype: the same fields in the same order, less `omit`,
+# with no alignment padding
+def packedDtype(dtype, omit=()):
+    return np.dtype([(name, dtype.fields[name][0]) for name in dtype.names if name not in omit])
+
+# The fields of a dtype among `names`, in the same order and alignment
+def selectedDtype(dtype, names):
+    return np.dtype([(name, dtype.fields[name][0]) for name in dtype.names if name in names],
+                    align=dtype.isalignedstruct)
+
+# Copy the fields of `dtype` out of rows with another layout
+def repackRows(rows, dtype):
+    packed = np.empty(len(rows), dtype=dtype)
+    for name in dtype.names:
+        packed[name] = rows[name]
+    return packed
+
+# JSON of the fields, offsets and size of a dtype, as kept in the full_dtype
+# attribute of packed datasets
+def dtypeJSON(dtype):
+    fields = [dtype.fields[name] for name in dtype.names]
+    return json.dumps(dict(names=list(dtype.names), formats=[[field[0].base.str, list(field[0].shape)] for field in fields],
+                           offsets=[field[1] for field in fields], itemsize=dtype.itemsize))
+
+# Output datasets for a set of conversion options: those of output_dtypes in
+# options["datasets"] (default all), with only the options["columns"] of
+# each, plus event_id, if given
+def outputDtypes(options):
+    datasets = options.get("datasets") or output_dtypes
+    dtypes = {name: dtype for name, dtype in output_dtypes.items() if name in datasets}
+    if options.get("evtcode_table") and "mc_hdr" in dtypes:
+        dtypes.update(mc_hdr=genie_hdr_evtcode_dtype, mc_evtcode=evtcode_dtype)
+    for name, columns in (options.get("columns") or dict()).items():
+        dtypes[name] = selectedDtype(dtypes[name], ["event_id"] + list(columns))
+    if options.get("packed"):
+        dtypes.update({name: packedDtype(dtypes[name], segments_placeholders if name == "segments" else ())
+                       for name in output_dtypes if name in dtypes})
+    if options.get("split_dets"):
+        dtypes.update(segment_containers=segment_containers_dtype)
+    if options.get("spill_index"):
+        # With split_dets, the segments of a spill are found from its segment_containers rows
+        indexed = [name for name in list(output_dtypes) + ["segment_containers"] if name in dtypes]
+        if options.get("split_dets") and "segments" in indexed:
+            indexed.remove("segments")
+        dtypes.update(spill_index=spillIndexDtype(indexed))
+    if options.get("ancestry_index"):
+        dtypes.update(traj_index=traj_index_dtype, traj_children=traj_children_dtype)
+        if "segments" in dtypes:
+            dtypes.update(segment_index=segment_index_dtype)
+    if options.get("prune"):
+        dtypes.update(segment_pruning=segment_pruning_dtype)
+    return dtypes
+
+# The datasets written as groups of one dataset per segment container (see
+# HDF5Writer)
+def outputGroups(options):
+    if not options.get("split_dets"):
+        return []
+    return [name for name in ["segments", "segment_index"] if name in outputDtypes(options)]
+
+# Chunk size presets, in bytes per chunk
+chunk_presets = {"small": 64 * 1024, "medium": 1024 * 1024, "large": 8 * 1024 * 1024}
+
+# Number of rows per chunk for a dataset, from a number of rows, the name of a
+# chunk_presets entry, or None (let h5py choose)
+def chunkRows(dtype, chunk_size):
+    if chunk_size is None or chunk_size == "auto":
+        return None
+    if isinstance(chunk_size, str):
+        if chunk_size not in chunk_presets:
+            raise ValueError(f"Unknown chunk size preset {chunk_size}, expected one of "
+                             f"{['auto'] + list(chunk_presets)}")
+        return max(1, chunk_presets[chunk_size] // dtype.itemsize)
+    return int(chunk_size)
+
+# create_dataset() filter arguments for a compression spec:
+#   "none"                        no compression
+#   "gzip[:level]"                gzip/deflate, level 0-9 (default 4)
+#   "lzf"                         LZF, fast with a moderate ratio
+#   "blosc[:compressor[:level]]"  Blosc (lz4 by default, also blosclz, lz4hc,
+#                                 zlib or zstd; level 0-9, default 5). Needs
+#                                 the hdf5plugin package, also for reading.
+# shuffle adds the byte shuffle filter (for Blosc, its internal shuffle).
+def compressionFilters(compression, shuffle):
+    if compression is None:
+        compression = "none"
+    name, *opts = str(compression).split(":")
+
+    if name == "none":
+        filters = dict()
+    elif name == "gzip":
+        filters = dict(compression="gzip", compression_opts=int(opts[0]) if opts else 4)
+    elif name == "lzf":
+        filters = dict(compression="lzf")
+    elif name == "blosc":
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError("Blosc compression requires the hdf5plugin package")
+        return dict(hdf5plugin.Blosc(cname=opts[0] if opts else "lz4",
+                                     clevel=int(opts[1]) if len(opts) > 1 else 5,
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE))
+    else:
+        raise ValueError(f"Unknown compression {compression}, expected none, gzip[:level], lzf "
+                         "or blosc[:compressor[:level]]")
+
+    if shuffle:
+        filters["shuffle"] = True
+    return filters
+
+# Appends batches of rows to the output datasets, keeping the HDF5 file open
+# for the whole conversion. Datasets are grown geometrically (by a factor
+# `growth`, or to fit the batch if that is larger) rather than by the exact
+# batch length, and trimmed to the rows actually written on close().
+# chunk_size (see chunkRows) and compression/shuffle (see compressionFilters)
+# are either one value for all datasets or a dict of {dataset: value}.
+# rdcc_nbytes and rdcc_nslots set the HDF5 chunk cache, None keeps the HDF5
+# default. dtypes gives the datasets to create (see outputDtypes).
+# With checkpoint, an existing output file holding a checkpoint (see
+# saveCheckpoint) is reopened rather than truncated: its datasets are cut back
+# to the rows written at the checkpoint, which is left in self.checkpoint
+# (None when starting afresh). `conversion` is a JSON-able dict of whatever
+# else the rows depend on (input file, entry range, conversion options); it is
+# saved with every checkpoint, and resuming from one saved with a different
+# conversion is refused like resuming with different datasets.
+# If dtypes includes spill_index, the rows of each spill in the output_dtypes
+# datasets are tracked as they are appended (the rows of a spill must be
+# contiguous) and written to it on close().
+# With spill_chunk_bytes (bytes or a chunk_presets name), the output_dtypes
+# datasets are laid out so that chunk boundaries fall between spills: their
+# rows are written in groups of whole spills of up to that size (a bigger
+# spill on its own), each as a single-chunk piece under spill_chunks/, and on
+# close() each dataset becomes a virtual dataset joining its pieces. Can't be
+# combined with checkpoint.
+# The dtypes named in `groups` (segments and segment_index, see
+# outputGroups) are written as groups of one dataset per segment container,
+# <name>/<container>, each created when the container first appears and
+# given the attributes of its group. update() routes the segments by their
+# segment_containers rows. Can't be combined with checkpoint.
+class HDF5Writer:
+    def __init__(self, output_file, chunk_size=None, rdcc_nbytes=None, rdcc_nslots=None, growth=2.,
+                 compression=None, shuffle=False, dtypes=output_dtypes, checkpoint=False,
+                 spill_chunk_bytes=None, groups=(), conversion=None):
+        cache = {key: val for key, val in [("rdcc_nbytes", rdcc_nbytes), ("rdcc_nslots", rdcc_nslots)]
+                 if val is not None}
+        self.file = None
+        self.growth = growth
+        self.dtypes = dtypes
+        self.groups = list(groups)
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.shuffle = shuffle
+        self.rows = dict()
+        self.checkpoint = None
+        self.conversion = json.loads(json.dumps(conversion))
+        self.spill_rows = dict() # {event_id: {dataset: [start, stop]}}, in order of first appearance
+        self.filters = dict()
+        self.pieces = dict() # {dataset: [piece, ...]}, with spill_chunk_bytes
+        self.pending = dict() # {dataset: rows not yet written to a piece}
+        if isinstance(spill_chunk_bytes, str):
+            if spill_chunk_bytes not in chunk_presets:
+                raise ValueError(f"Unknown chunk size preset {spill_chunk_bytes}, expected one of {list(chunk_presets)}")
+            spill_chunk_bytes = chunk_presets[spill_chunk_bytes]
+        self.spill_chunk_bytes = spill_chunk_bytes
+
+        if checkpoint and h5py.is_hdf5(output_file):
+            self.file = h5py.File(output_file, 'a', **cache)
+            if "checkpoint" not in self.file.attrs:
+                self.file.close()
+                self.file = None
+            elif (set(self.file) != set(dtypes)
+                  or any(self.file[name].dtype.names != dtype.names for name, dtype in dtypes.items())
+                  or json.loads(self.file.attrs["checkpoint"]).get("conversion") != self.conversion):
+                self.file.close()
+                raise ValueError(f"Can't resume {output_file}, it was written with different dataset options")
+            else:
+                self.checkpoint = json.loads(self.file.attrs["checkpoint"])
+                self.rows = self.checkpoint.pop("rows")
+                self.checkpoint.pop("conversion")
+                for name, nrows in self.rows.items():
+                    self.file[name].resize((nrows,))
+                if "spill_index" in dtypes:
+                    for name in dtypes["spill_index"].names[1:]:
+                        for start in range(0, self.rows[name], 1000000):
+                            self.indexSpills(name, self.file[name].fields("event_id")[start:start+1000000], start)
+                return
+
+        self.file = h5py.File(output_file, 'w', **cache)
+        for name in dtypes:
+            if name in self.groups:
+                self.file.create_group(name)
+            else:
+                self.createDataset(name)
+
+    # Create an empty dataset, or a dataset <group>/<container> of one of the
+    # groups, with the chunk size and filters given for its dtype
+    def createDataset(self, name):
+        base = name.split("/")[0]
+        dtype = self.dtypes[base]
+        chunks = chunkRows(dtype, self.chunk_size.get(base) if isinstance(self.chunk_size, dict) else self.chunk_size)
+        filters = compressionFilters(self.compression.get(base) if isinstance(self.compression, dict)
+                                     else self.compression,
+                                     self.shuffle.get(base, False) if isinstance(self.shuffle, dict) else self.shuffle)
+        self.file.create_dataset(name, (0,), dtype=dtype, maxshape=(None,),
+                                 chunks=(chunks,) if chunks else True, **filters)
+        if base in self.groups:
+            self.file[name].attrs.update(self.file[base].attrs)
+        self.rows[name] = 0
+        self.filters[name] = filters
+        if self.spill_chunk_bytes and base in output_dtypes:
+            self.pieces[name] = list()
+            self.pending[name] = np.empty((0,), dtype=dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(complete=exc_type is None)
+
+    # Append rows to one dataset, repacked if they have another layout
+    def append(self, name, rows):
+        if not len(rows):
+            return
+        dtype = self.dtypes[name.split("/")[0]]
+        if rows.dtype != dtype:
+            rows = repackRows(rows, dtype)
+        if name not in self.rows:
+            self.createDataset(name)
+        nrows = self.rows[name]
+        if name in self.pieces:
+            self.pending[name] = np.concatenate((self.pending[name], rows))
+            self.writePieces(name)
+        else:
+            dset = self.file[name]
+            if nrows + len(rows) > len(dset):
+                dset.resize((max(nrows + len(rows), int(len(dset) * self.growth)),))
+            dset[nrows:nrows+len(rows)] = rows
+        self.rows[name] += len(rows)
+        if "spill_index" in self.dtypes and name in self.dtypes["spill_index"].names[1:]:
+            self.indexSpills(name, rows["event_id"], nrows)
+
+    # Write the pending rows of a dataset as pieces of whole spills, each as
+    # big as fits in spill_chunk_bytes. The last pending spill may go on in
+    # the next rows, so a piece is only written once the spill after it
+    # doesn't fit, unless `final`.
+    def writePieces(self, name, final=False):
+        pending = self.pending[name]
+        max_rows = max(1, self.spill_chunk_bytes // pending.dtype.itemsize)
+        event_id = pending["event_id"]
+        ends = np.append(np.flatnonzero(event_id[1:] != event_id[:-1]) + 1, len(pending))
+        first = 0
+        while first < len(pending):
+            ends = ends[ends > first]
+            fit = max(1, np.count_nonzero(ends - first <= max_rows))
+            if fit == len(ends) and not final:
+                break
+            stop = ends[fit-1]
+            piece = f"spill_chunks/{name}/{len(self.pieces[name]):06d}"
+            self.file.create_dataset(piece, data=pending[first:stop], chunks=(stop-first,), **self.filters[name])
+            self.pieces[name].append(piece)
+            first = stop
+        self.pending[name] = pending[first:]
+
+    # Replace a dataset by a virtual dataset joining its pieces, keeping its
+    # attributes
+    def joinPieces(self, name):
+        self.writePieces(name, final=True)
+        if not self.pieces[name]:
+            return
+        layout = h5py.VirtualLayout(shape=(self.rows[name],), dtype=self.dtypes[name.split("/")[0]])
+        first = 0
+        for piece in self.pieces[name]:
+            nrows = len(self.file[piece])
+            layout[first:first+nrows] = h5py.VirtualSource(".", piece, shape=(nrows,))
+            first += nrows
+        attrs = dict(self.file[name].attrs)
+        del self.file[name]
+        self.file.create_virtual_dataset(name, layout)
+        self.file[name].attrs.update(attrs)
+
+    # Record the rows of each spill among rows of dataset `name` with the given
+    # event_ids, appended from row `first` on
+    def indexSpills(self, name, event_id, first):
+        if not len(event_id):
+            return
+        starts = np.concatenate(([0], np.flatnonzero(event_id[1:] != event_id[:-1]) + 1))
+        stops = np.append(starts[1:], len(event_id))
+        for spill, start, stop in zip(event_id[starts].tolist(), (starts + first).tolist(), (stops + first).tolist()):
+            regions = self.spill_rows.setdefault(spill, dict())
+            if name in regions and regions[name][1] == start:
+                regions[name][1] = stop
+            else:
+                regions[name] = [start, stop]
+
+    # spill_index rows for the spills seen so far. A spill with no rows in a
+    # dataset gets an empty region where its rows would be.
+    def spillIndex(self):
+        index = np.zeros(len(self.spill_rows), dtype=self.dtypes["spill_index"])
+        index["event_id"] = list(self.spill_rows)
+        for name in self.dtypes["spill_index"].names[1:]:
+            cursor = 0
+            regions = np.empty((len(self.spill_rows), 2), dtype='i8')
+            for i, spill_regions in enumerate(self.spill_rows.values()):
+                regions[i] = spill_regions.get(name, (cursor, cursor))
+                cursor = regions[i, 1]
+            index[name]["start"] = regions[:, 0]
+            index[name]["stop"] = regions[:, 1]
+        return index
+
+    # Append the segments of a batch, and their segment_index if given, to the
+    # datasets of their containers, as laid out by the segment_containers rows
+    # of the batch (whose rows regions count from 0), and the
+    # segment_containers rows with the regions the segments went to
+    def routeSegments(self, segments, containers, segment_index=None):
+        if not len(containers):
+            return
+        counts = containers["rows"]["stop"] - containers["rows"]["start"]
+        segment_container = np.repeat(np.arange(len(containers)), counts)
+        for detector in np.unique(containers["detector"]):
+            in_detector = containers["detector"] == detector
+            name = detector.decode()
+            stops = self.rows.get(f"segments/{name}", 0) + np.cumsum(counts[in_detector])
+            containers["rows"]["start"][in_detector] = stops - counts[in_detector]
+            containers["rows"]["stop"][in_detector] = stops
+            selected = in_detector[segment_container]
+            self.append(f"segments/{name}", segments[selected])
+            if segment_index is not None:
+                self.append(f"segment_index/{name}", segment_index[selected])
+        self.append('segment_containers', containers)
+
+    # Append one batch of each output array, made of whole events, and its
+    # ancestry index if dtypes includes traj_index
+    def update(self, trajectories, segments, vertices, genie_s, genie_h, pruning, containers):
+        segment_index = None
+        if "traj_index" in self.dtypes and len(trajectories):
+            traj_index, traj_children = ancestryIndex(trajectories, self.rows["trajectories"],
+                                                      self.rows["traj_children"])
+            self.append('traj_index', traj_index)
+            self.append('traj_children', traj_children)
+            if "segment_index" in self.dtypes:
+                segment_index = segmentIndex(trajectories, segments, self.rows["trajectories"])
+        self.append('trajectories', trajectories)
+        if "segments" in self.groups:
+            self.routeSegments(segments, containers, segment_index)
+        else:
+            if segment_index is not None:
+                self.append('segment_index', segment_index)
+            self.append('segments', segments)
+        self.append('vertices', vertices)
+        self.append('mc_stack', genie_s)
+        self.append('mc_hdr', genie_h)
+        if "segment_pruning" in self.dtypes:
+            self.append('segment_pruning', pruning)
+
+    # Record how far the conversion got, as a progress dict from
+    # snapshotState(), together with the rows written so far and the
+    # conversion they came from, so that an interrupted run can carry on from
+    # here. The rows are flushed to disk before the checkpoint that counts
+    # them, and the checkpoint right after. HDF5 has no journal, though: the
+    # file is only consistent between flushes, and a run killed while one is
+    # under way (or while a dataset is being resized) may leave it unreadable.
+    def saveCheckpoint(self, progress):
+        self.file.flush()
+        self.file.attrs["checkpoint"] = json.dumps(dict(progress, rows=self.rows, conversion=self.conversion))
+        self.file.flush()
+
+    # Sum the segment_pruning rows, written one per event so that rows already
+    # checkpointed are never rewritten, into one row per spill (also in the
+    # checkpoint, if any)
+    def sumPruning(self):
+        rows = self.file["segment_pruning"][:self.rows["segment_pruning"]]
+        if not len(rows):
+            return
+        starts = np.concatenate(([0], np.flatnonzero(rows["event_id"][1:] != rows["event_id"][:-1]) + 1))
+        spills = rows[starts]
+        for name in prune_rules + ["kept"]:
+            spills[name]["segments"] = np.add.reduceat(rows[name]["segments"], starts)
+            spills[name]["dE"] = np.add.reduceat(rows[name]["dE"], starts)
+        self.file["segment_pruning"][:len(spills)] = spills
+        self.rows["segment_pruning"] = len(spills)
+        if "checkpoint" in self.file.attrs:
+            checkpoint = json.loads(self.file.attrs["checkpoint"])
+            checkpoint["rows"]["segment_pruning"] = len(spills)
+            self.file.attrs["checkpoint"] = json.dumps(checkpoint)
+
+    # Write the spill index, sum segment_pruning per spill unless the
+    # conversion failed (so that it can carry on from its checkpoint), trim the
+    # datasets to the rows written (or join their pieces) and close the file
+    def close(self, complete=True):
+        if not self.file:
+            return
+        if "segment_pruning" in self.dtypes and complete:
+            self.sumPruning()
+        if "spill_index" in self.dtypes:
+            self.append("spill_index", self.spillIndex())
+        for name, nrows in self.rows.items():
+            if name in self.pieces:
+                self.joinPieces(name)
+            else:
+                self.file[name].resize((nrows,))
+        self.file.close()
+
+# Read EDepSimEvents entries [entry_start, entry_stop) with one C++ call (see
+# convert2h5_packEvents) into the edep-sim part of a readBlocksROOT block. The
+# trajectory kinematics and points are skipped unless trajectories is set.
+def readEventsROOT(inputTree, entry_start, entry_stop, trajectories=True):
+    declareROOTHelpers()
+    events = ROOT.Convert2h5Events()
+    ROOT.convert2h5_packEvents(inputTree, entry_start, entry_stop, trajectories, events)
+
+    entries = np.array(events.entries, dtype='i8').reshape(-1, 5)
+    block = dict(entries=np.arange(entry_start, entry_stop), run_id=entries[:, 0], event_id=entries[:, 1])
+    for name, counts in [("vtx_offsets", entries[:, 2]), ("traj_offsets", entries[:, 3]),
+                         ("det_offsets", entries[:, 4])]:
+        block[name] = np.zeros(len(counts)+1, dtype='i8')
+        np.cumsum(counts, out=block[name][1:])
+
+    block["vtx_pos"] = np.array(events.vertices, dtype='f8').reshape(-1, 4)
+
+    table = np.array(events.trajectories, dtype='i8').reshape(-1, 4)
+    block["traj_track_id"], block["traj_parent_id"], block["traj_pdg"] = table[:, 0], table[:, 1], table[:, 2]
+    if trajectories:
+        block["traj_init_mom"] = np.array(events.init_mom, dtype='f8').reshape(-1, 4)
+        block["point_offsets"] = np.zeros(len(table)+1, dtype='i8')
+        np.cumsum(table[:, 3], out=block["point_offsets"][1:])
+        points = np.array(events.points, dtype='f8').reshape(-1, 9)
+        block["point_pos"], block["point_mom"] = points[:, 0:4], points[:, 4:7]
+        block["point_process"], block["point_subprocess"] = points[:, 7].astype('i8'), points[:, 8].astype('i8')
+
+    block["det_name"] = np.array([str(name) for name in events.names], dtype=object)
+    block["hit_offsets"] = np.zeros(len(block["det_name"])+1, dtype='i8')
+    np.cumsum(np.array(events.containers, dtype='i8'), out=block["hit_offsets"][1:])
+    hits = np.array(events.hits, dtype='f8').reshape(-1, 10)
+    block["hit_start"], block["hit_stop"] = hits[:, 0:4], hits[:, 4:8]
+    block["hit_edep"], block["hit_contrib"] = hits[:, 8], hits[:, 9].astype('i8')
+    return block
+
+# Read the EDepSimEvents (and GENIE, if genieTree is given) entries
+# [entry_start, entry_stop) in blocks, and yield each block as a dict of flat
+# numpy arrays. Ragged quantities are stored flat together with an offsets
+# array per level of nesting, so that e.g. the trajectories of event i are
+# traj_*[traj_offsets[i]:traj_offsets[i+1]] and the points of trajectory j are
+# point_*[point_offsets[j]:point_offsets[j+1]]. block_size is a number of
+# entries, or a function called before each block that returns one. The
+# trajectory kinematics and points are skipped unless trajectories is set.
+def readBlocksROOT(inputTree, genieTree, block_size, entry_start, entry_stop, trajectories=True):
+    start = entry_start
+    while start < entry_stop:
+        stop = min(start + (block_size() if callable(block_size) else block_size), entry_stop)
+        block = readEventsROOT(inputTree, start, stop, trajectories)
+        if genieTree:
+            block.update(readGenieROOT(genieTree, start, stop))
+        yield block
+        start = stop
+
+# Bytes held while converting a raw block from readBlocksROOT: the block's
+# own arrays (and the detector name strings), plus the block-wide segment and
+# trajectory arrays that convertBlock fills from them before splitting events.
+def blockBytes(block, options):
+    nbytes = sum(array.nbytes for array in block.values() if isinstance(array, np.ndarray))
+    nbytes += sum(len(name) for name in block["det_name"])
+    if "segments" in options["datasets"]:
+        nbytes += len(block["hit_edep"]) * segments_dtype.itemsize
+    if "point_offsets" in block:
+        nbytes += len(block["traj_track_id"]) * trajectories_dtype.itemsize
+    return nbytes
+
+# Convert a raw block from readBlocksROOT into output arrays. Follows the
+# same per-event logic as the PyROOT loop in dump(), so that both engines
+# produce identical datasets. The counters in `state` carry over between
+# blocks. Only the datasets in options["datasets"] are filled; the block needs
+# the trajectory kinematics if trajectories or mc_stack are among them.
+def convertBlock(block, state, spill_map, spillPeriod_s, keep_all_dets, options):
+    active_volume = os.environ.get("ARCUBE_ACTIVE_VOLUME", "volTPCActive")
+    datasets = options["datasets"]
+    have_genie = "genie_offsets" in block
+    need_trajectories = "trajectories" in datasets or "mc_stack" in datasets
 
-    # Get the input tree out of the file.
-    inputFile = TFile(input_file)
-    inputTree = inputFile.Get("EDepSimEvents")
-    genieTree = inputFile.Get("DetSimPassThru/gRooTracker")
-    # print("Class: ", inputTree.ClassName())
-    # print("Class: ", genieTree.ClassName())
+    segments_list = list()
+    trajectories_list = list()
+    vertices_list = list()
+    genie_stack_list = list()
+    genie_hdr_list = list()
+    pruning_list = list()
+    containers_list = list()
+
+    # Kinematics of every hit segment and trajectory in the block at once, and
+    # which are pruned; the ID fields are filled per event below
+    if "segments" in datasets:
+        with profile.phase("segment_fill"):
+            block_segments = fillSegments(block["hit_start"], block["hit_stop"], block["hit_edep"])
+            if options["prune"]:
+                block_rule = pruneRule(block["hit_start"], block["hit_stop"], block["hit_edep"], options["prune"])
+    if need_trajectories:
+        with profile.phase("trajectory_fill"):
+            block_trajectories = fillTrajectories(block["traj_track_id"], block["traj_parent_id"], block["traj_pdg"],
+                                                  block["traj_init_mom"], block["point_offsets"], block["point_pos"],
+                                                  block["point_mom"], block["point_process"], block["point_subprocess"])
+
+    # Spill of every entry in the block, and its time
+    if spill_map is not None:
+        with profile.phase("spill_lookup"):
+            block_spills = lookupSpills(spill_map, block["run_id"], block["event_id"])
+            block_t_spill = countSpills(block_spills, state) * spillPeriod_s * 1E6 # convert to us
+
+    # GENIE header of every entry in the block
+    if have_genie and "mc_hdr" in datasets:
+        with profile.phase("genie_header"):
+            genie_hdrs = fillGenieHeaders(block, options["beam_dir"], state["evtcodes"])
+
+    for iEvt in range(len(block["entries"])):
+        run_id, event_id = int(block["run_id"][iEvt]), int(block["event_id"][iEvt])
+        globalVertexID = (run_id * 1E6) + event_id
+
+        if spill_map is None:
+            spill_it = globalVertexID
+            t_spill = 0.
+        else:
+            spill_it = int(block_spills[iEvt])
+            t_spill = float(block_t_spill[iEvt])
 
-    # IF CRASH: Uncomment this section (also see IF CRASH below)
-    # Attach a brach to the events.
-    # event = TG4Event()
-    # inputTree.SetBranchAddress("Event",event)
+        det_first, det_last = block["det_offsets"][iEvt], block["det_offsets"][iEvt+1]
+        det_names = block["det_name"][det_first:det_last]
+        if keep_all_dets:
+            if len(det_names) == 0:
+                continue
+        elif not any(containerName == active_volume for containerName in det_names):
+            continue
 
-    # map that gives which spill each event lives in
-    event_spill_map = inputFile.Get("event_spill_map")
+        # Dump the primary vertices
+        if "vertices" in datasets:
+            with profile.phase("vertex_fill"):
+                vtx_pos = block["vtx_pos"][block["vtx_offsets"][iEvt]:block["vtx_offsets"][iEvt+1]]
+                vertices = np.empty(len(vtx_pos), dtype=vertices_dtype)
+                vertices["event_id"] = spill_it
+                vertices["vertex_id"] = globalVertexID
+                vertices["x_vert"] = vtx_pos[:, 0] * edep2cm
+                vertices["y_vert"] = vtx_pos[:, 1] * edep2cm
+                vertices["z_vert"] = vtx_pos[:, 2] * edep2cm
+                vertices["t_vert"] = vtx_pos[:, 3] * edep2us
+                vertices["t_event"] = t_spill
+                vertices_list.append(vertices)
+
+        # Unique-in-file track IDs, assigned in trajectory order
+        with profile.phase("ancestry"):
+            traj_first, traj_last = block["traj_offsets"][iEvt], block["traj_offsets"][iEvt+1]
+            track_ids = block["traj_track_id"][traj_first:traj_last]
+            parent_ids = block["traj_parent_id"][traj_first:traj_last]
+            trackMap = dict(zip(track_ids.tolist(), range(state["trackCounter"], state["trackCounter"] + len(track_ids))))
+            state["trackCounter"] += len(track_ids)
+
+        # Dump the segment containers, with the PDG code of each contributor,
+        # and collect the contributors for the ancestry
+        event_contribs = list()
+        event_rules = list()
+        event_energies = list()
+        if "segments" in datasets or need_trajectories:
+            with profile.phase("segment_fill"):
+                trackPdg = dict(zip(track_ids.tolist(), block["traj_pdg"][traj_first:traj_last].tolist()))
+                for iDet in range(det_first, det_last):
+                    if (not keep_all_dets) and block["det_name"][iDet] != active_volume:
+                        continue
+                    hit_first, hit_last = block["hit_offsets"][iDet], block["hit_offsets"][iDet+1]
+                    contrib = block["hit_contrib"][hit_first:hit_last]
+                    segment = block_segments[hit_first:hit_last] if "segments" in datasets else None
+                    if options["prune"]:
+                        rule = block_rule[hit_first:hit_last]
+                        event_rules.append(rule)
+                        event_energies.append(block["hit_edep"][hit_first:hit_last])
+                        keep = rule == len(prune_rules)
+                        contrib, segment = contrib[keep], segment[keep]
+                    event_contribs.append(contrib)
+                    if "segments" not in datasets:
+                        continue
+                    segment["event_id"] = spill_it
+                    segment["vertex_id"] = globalVertexID
+                    segment["segment_id"] = np.arange(state["segment_id"], state["segment_id"] + len(segment))
+                    if options["split_dets"]:
+                        containers_list.append(containerRow(spill_it, globalVertexID, block["det_name"][iDet],
+                                                            state["segment_id"], len(segment)))
+                    state["segment_id"] += len(segment)
+                    segment["traj_id"] = contrib
+                    segment["file_traj_id"], segment["pdg_id"] = contributorIDs(contrib, trackMap, trackPdg)
+                    segments_list.append(segment)
+                if options["prune"]:
+                    pruning_list.append(pruningRow(event_rules, event_energies, spill_it))
+
+        # Dump the primary trajectories and the ancestry of every contributor
+        if need_trajectories:
+            with profile.phase("ancestry"):
+                contribs = np.concatenate(event_contribs) if event_contribs else np.empty((0,), dtype='i8')
+                order = resolveAncestry(track_ids, parent_ids, contribs)
+            with profile.phase("trajectory_fill"):
+                trajectories = block_trajectories[traj_first + order]
+                trajectories["event_id"] = spill_it
+                trajectories["vertex_id"] = globalVertexID
+                trajectories["file_traj_id"] = [trackMap[traj_id] for traj_id in track_ids[order].tolist()]
+                if "trajectories" in datasets:
+                    trajectories_list.append(trajectories)
 
-    if not event_spill_map:
-        spillPeriod_s = 0.
+        # Save truth information from GENIE
+        if have_genie and "mc_stack" in datasets:
+            with profile.phase("genie_stack"):
+                p_first, p_last = block["genie_offsets"][iEvt], block["genie_offsets"][iEvt+1]
+                genie_stack = fillGenieStack(block["stdhep_status"][p_first:p_last], block["stdhep_pdg"][p_first:p_last],
+                                             block["stdhep_p4"][p_first:p_last], trajectories, options)
+                genie_stack["event_id"] = spill_it
+                genie_stack["vertex_id"] = globalVertexID
+                genie_stack_list.append(genie_stack)
+
+        if have_genie and "mc_hdr" in datasets:
+            with profile.phase("genie_header"):
+                genie_hdr = genie_hdrs[[iEvt]]
+                genie_hdr["event_id"] = spill_it
+                genie_hdr["vertex_id"] = globalVertexID
+                genie_hdr_list.append(genie_hdr)
+
+    return (trajectories_list, segments_list, vertices_list, genie_stack_list, genie_hdr_list,
+            pruning_list, containers_list)
+
+# Copy of the running counters in `state` once the input is converted up to
+# (not including) entry, as saved by HDF5Writer.saveCheckpoint()
+def snapshotState(state, entry):
+    return dict(state, entry=int(entry), spillCounter=int(state["spillCounter"]),
+                evtcodes=None if state["evtcodes"] is None else dict(state["evtcodes"]))
+
+# Concatenate the per-event output arrays collected since the last flush into
+# one batch for HDF5Writer.update()
+def concatBatch(trajectories_list, segments_list, vertices_list, genie_stack_list, genie_hdr_list, pruning_list,
+                containers_list):
+    return (np.concatenate(trajectories_list, axis=0) if trajectories_list else np.empty((0,)),
+            np.concatenate(segments_list, axis=0) if segments_list else np.empty((0,)),
+            np.concatenate(vertices_list, axis=0) if vertices_list else np.empty((0,)),
+            np.concatenate(genie_stack_list, axis=0) if genie_stack_list else np.empty((0,)),
+            np.concatenate(genie_hdr_list, axis=0) if genie_hdr_list else np.empty((0,)),
+            np.concatenate(pruning_list, axis=0) if pruning_list else np.empty((0,)),
+            np.concatenate(containers_list, axis=0) if containers_list else np.empty((0,)))
+
+# Context manager doing nothing, standing in for phases while profiling is
+# disabled (contextlib.nullcontext needs Python 3.7)
+class NoPhase:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+no_phase = NoPhase()
+
+# Accumulates the wall time and number of calls of each phase of a conversion
+# ("root_read", "spill_lookup", "vertex_fill", "trajectory_fill", "ancestry",
+# "segment_fill", "genie_stack", "genie_header", "hdf5_write"), when enabled.
+# Phases may be timed from several threads, so with queue_depth > 0 their
+# times add up to more than the wall time.
+class Profiler:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.times = dict()
+        self.calls = dict()
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    # Context manager timing one call of a phase (doing nothing if disabled)
+    def phase(self, name):
+        return self.timed(name) if self.enabled else no_phase
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds, calls=1):
+        with self.lock:
+            self.times[name] = self.times.get(name, 0.) + seconds
+            self.calls[name] = self.calls.get(name, 0) + calls
+
+    # Time taking each item from an iterable as one call of a phase
+    def iterate(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    # Add the phases of another Profiler, as returned by totals()
+    def merge(self, totals):
+        for name, phase in totals.items():
+            self.add(name, phase["time"], phase["calls"])
+
+    def totals(self):
+        return {name: dict(time=self.times[name], calls=self.calls[name]) for name in self.times}
+
+    # Write the phases, the rows written per dataset (from HDF5Writer.rows)
+    # and the peak resident memory as JSON, together with `info`
+    def write(self, path, rows, info):
+        wall_time = time.perf_counter() - self.start
+        report = dict(info, wall_time=wall_time, phases=self.totals(),
+                      rows={name: dict(rows=nrows, rows_per_s=nrows / wall_time) for name, nrows in rows.items()},
+                      peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                      peak_rss_children_mb=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=4)
+            f.write('\n')
+
+# Phase timings of the current conversion; replaced by dump() and dumpShard()
+profile = Profiler()
+
+# Run the items of a source iterable through a chain of stages, given as
+# (name, iterable) and a list of (name, function); each function is applied
+# to the result of the previous one and the results of the last are dropped.
+# With queue_depth > 0 the source and every stage run in their own thread,
+# connected by queues holding at most queue_depth items, so that the stages
+# overlap. Returns the time in seconds each of them spent blocked, waiting on
+# its input queue ("input") or for room in its output queue ("output").
+def runPipeline(source, stages, queue_depth):
+    import queue
+
+    if queue_depth <= 0:
+        for item in source[1]:
+            for _name, stage in stages:
+                item = stage(item)
+        return dict()
+
+    done = object()
+    abort = threading.Event()
+    errors = list()
+    blocked = {name: dict(input=0., output=0.) for name, _ in [source] + stages}
+    queues = [queue.Queue(queue_depth) for _ in stages]
+
+    # Blocking put/get that give up once any stage has failed
+    def put(name, q, item):
+        start = time.perf_counter()
+        while not abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        blocked[name]["output"] += time.perf_counter() - start
+
+    def get(name, q):
+        start = time.perf_counter()
+        item = done
+        while not abort.is_set():
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        blocked[name]["input"] += time.perf_counter() - start
+        return item
+
+    def runSource():
+        try:
+            for item in source[1]:
+                if abort.is_set():
+                    return
+                put(source[0], queues[0], item)
+            put(source[0], queues[0], done)
+        except BaseException as e:
+            errors.append(e)
+            abort.set()
+
+    def runStage(iStage):
+        name, stage = stages[iStage]
+        last = iStage == len(stages) - 1
+        try:
+            while True:
+                item = get(name, queues[iStage])
+                if item is done:
+                    break
+                item = stage(item)
+                if not last:
+                    put(name, queues[iStage+1], item)
+            if not last:
+                put(name, queues[iStage+1], done)
+        except BaseException as e:
+            errors.append(e)
+            abort.set()
+
+    # The last stage (usually the HDF5 write) runs in the calling thread
+    threads = [threading.Thread(target=runSource, daemon=True)]
+    threads += [threading.Thread(target=runStage, args=(iStage,), daemon=True)
+                for iStage in range(len(stages)-1)]
+    for thread in threads:
+        thread.start()
+    runStage(len(stages)-1)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return blocked
+
+# Sub-branches of the (split) Event branch of EDepSimEvents that the given
+# datasets need: the event ids, the segment containers and the trajectory
+# table always (for selecting events and assigning track IDs), the trajectory
+# points and momenta for trajectories and mc_stack, and the vertex positions
+# for vertices
+def inputBranches(datasets):
+    branches = ["RunId", "EventId", "SegmentDetectors", "SegmentDetectors.first", "SegmentDetectors.second",
+                "Trajectories", "Trajectories.TrackId", "Trajectories.ParentId", "Trajectories.PDGCode"]
+    if "trajectories" in datasets or "mc_stack" in datasets:
+        branches += ["Trajectories.Points", "Trajectories.InitialMomentum"]
+    if "vertices" in datasets:
+        branches += ["Primaries", "Primaries.Position"]
+    return branches
+
+# Disable every branch of the input tree but those the datasets need (see
+# inputBranches), so that GetEntry doesn't deserialise the rest of each
+# TG4Event. A tree whose Event branch isn't split that way is read whole.
+def selectBranches(inputTree, datasets):
+    branches = inputBranches(datasets)
+    if not all(inputTree.GetBranch(name) for name in branches):
+        return
+    inputTree.SetBranchStatus("*", 0)
+    for name in branches:
+        inputTree.SetBranchStatus(name, 1)
+
+# Dump entries [entry_start, entry_stop) of the input into the writer, in
+# blocks of block_size entries (bulk engine) or events (PyROOT engine), or
+# of about options["flush_bytes"] of output if that is set. The running
+# counters start from, and are saved back to, `state`. With queue_depth > 0
+# reading, converting and writing run as a pipeline (see runPipeline; with
+# PyROOT, reading and converting share a thread) and the time each stage spent
+# blocked is printed, as is the peak size of the output waiting to be written.
+def dumpEntries(inputTree, genieTree, writer, engine, keep_all_dets, block_size, queue_depth,
+                spill_map, spillPeriod_s, entry_start, entry_stop, state, options):
+    # Each batch comes with the progress it completes, see snapshotState()
+    def write(item):
+        batch, progress = item
+        with profile.phase("hdf5_write"):
+            writer.update(*batch)
+            if options["checkpoint"]:
+                writer.saveCheckpoint(progress)
+
+    selectBranches(inputTree, options["datasets"])
+
+    if engine == "bulk":
+        need_trajectories = "trajectories" in options["datasets"] or "mc_stack" in options["datasets"]
+        need_genie = "mc_stack" in options["datasets"] or "mc_hdr" in options["datasets"]
+
+        # A block holds its raw arrays, the intermediates convertBlock fills
+        # from them and its output batch, and up to queue_depth + 2 blocks are
+        # in flight at once (one being read, queue_depth queued and one
+        # converted or written). With flush_bytes, each block is sized so that
+        # all of them together fill the budget, going by the bytes per entry
+        # of the previous block (the first one being a small probe)
+        in_flight = queue_depth + 2
+        sizing = dict(entries=min(block_size, 10) if options["flush_bytes"] else block_size)
+
+        with tqdm(total=entry_stop-entry_start) as pbar:
+            def convert(block):
+                working = blockBytes(block, options)
+                batch = concatBatch(*convertBlock(block, state, spill_map, spillPeriod_s, keep_all_dets, options))
+                nbytes = (working + sum(array.nbytes for array in batch)) * in_flight
+                state["peak_buffered"] = max(state["peak_buffered"], nbytes)
+                if options["flush_bytes"]:
+                    nentries = len(block["entries"])
+                    sizing["entries"] = max(1, int(options["flush_bytes"] * nentries / nbytes)) if nbytes else 2 * nentries
+                pbar.update(len(block["entries"]))
+                return batch, snapshotState(state, block["entries"][-1] + 1)
+
+            blocked = runPipeline(("read", profile.iterate("root_read",
+                                                           readBlocksROOT(inputTree, genieTree if need_genie else None,
+                                                                          lambda: sizing["entries"],
+                                                                          entry_start, entry_stop,
+                                                                          trajectories=need_trajectories))),
+                                  [("convert", convert), ("write", write)], queue_depth)
     else:
-        spillPeriod_s = inputFile.Get("spillPeriod_s").GetVal()
-        # for setting t_spill
-        spillCounter = -1
-        lastSpill = None        # Most-recent global spill ID
-
-    # Read all of the events.
-    entries = inputTree.GetEntriesFast()
-
-    if genieTree:
-        genie_entries = genieTree.GetEntriesFast()
-
-        # Check that the edep-sim and GENIE trees have the same number of events
-        if entries != genie_entries:
-            print("Edep-sim tree and GENIE tree number of entries do not match!")
-            return
+        blocked = runPipeline(("read+convert", convertROOT(inputTree, genieTree, keep_all_dets, block_size,
+                                                           spill_map, spillPeriod_s,
+                                                           entry_start, entry_stop, state, options)),
+                              [("write", write)], queue_depth)
+
+    if blocked:
+        print("Time blocked per pipeline stage (s):",
+              ", ".join(f"{name} {times['input']:.2f} on input, {times['output']:.2f} on output"
+                        for name, times in blocked.items()))
+    print(f"Peak buffered data: {state['peak_buffered'] / 1e6:.1f} MB")
+
+# Read entries [entry_start, entry_stop) of the input one at a time with
+# PyROOT and convert them, yielding a batch of output arrays (see concatBatch)
+# and the progress it completes (see snapshotState) every block_size events,
+# or once the pending arrays reach options["flush_bytes"] if that is set.
+# The running counters start from, and are saved back to, `state`. Only the
+# datasets in options["datasets"] are filled.
+def convertROOT(inputTree, genieTree, keep_all_dets, block_size, spill_map, spillPeriod_s,
+                entry_start, entry_stop, state, options):
+    datasets = options["datasets"]
+    need_genie = genieTree and ("mc_stack" in datasets or "mc_hdr" in datasets)
+    need_trajectories = "trajectories" in datasets or "mc_stack" in datasets
 
     segments_list = list()
     trajectories_list = list()
     vertices_list = list()
     genie_stack_list = list()
     genie_hdr_list = list()
+    pruning_list = list()
+    containers_list = list()
+    pending_bytes = 0 # size of the arrays in the lists above
+    pending_events = 0 # events in the lists above
+    genie_bytes = 0 # size of the GENIE block being converted, and its headers
 
-    # For assigning unique-in-file track IDs:
-    trackCounter = 0
+    segment_id = state["segment_id"]
 
-    for jentry in tqdm(range(entries)):
+    # For assigning unique-in-file track IDs:
+    trackCounter = state["trackCounter"]
+
+    # Spill of every entry, and its time, for setting t_spill
+    first_spill = dict(spillCounter=state["spillCounter"], lastSpill=state["lastSpill"])
+    if spill_map is not None:
+        with profile.phase("spill_lookup"):
+            run_ids, event_ids = readEventIds(inputTree, entry_start, entry_stop)
+            entry_spills = lookupSpills(spill_map, run_ids, event_ids)
+            entry_counters = countSpills(entry_spills, state)
+            entry_t_spill = entry_counters * spillPeriod_s * 1E6 # convert to us
+
+    # Progress once entries up to (not including) jentry are converted
+    def progress(jentry):
+        counters = dict(state, segment_id=segment_id, trackCounter=trackCounter, **first_spill)
+        if spill_map is not None and jentry > entry_start:
+            counters.update(spillCounter=entry_counters[jentry - entry_start - 1],
+                            lastSpill=int(entry_spills[jentry - entry_start - 1]))
+        return snapshotState(counters, jentry)
+
+    for jentry in tqdm(range(entry_start, entry_stop)):
         #print(jentry,"/",entries)
-        nb = inputTree.GetEntry(jentry)
-        if genieTree:
-            gb = genieTree.GetEntry(jentry)
+        with profile.phase("root_read"):
+            nb = inputTree.GetEntry(jentry)
+
+        # Read and summarise the GENIE entries block_size at a time
+        if need_genie:
+            if (jentry - entry_start) % block_size == 0:
+                with profile.phase("root_read"):
+                    genie = readGenieROOT(genieTree, jentry, min(jentry + block_size, entry_stop))
+                genie_bytes = sum(array.nbytes for array in genie.values() if isinstance(array, np.ndarray))
+                if "mc_hdr" in datasets:
+                    with profile.phase("genie_header"):
+                        genie_hdrs = fillGenieHeaders(genie, options["beam_dir"], state["evtcodes"])
+                    genie_bytes += genie_hdrs.nbytes
+            iGenie = (jentry - entry_start) % block_size
 
         # IF CRASH: Comment this line (also see IF CRASH above)
         event = inputTree.Event
 
         globalVertexID = (event.RunId * 1E6) + event.EventId
 
-        if not event_spill_map:
+        if spill_map is None:
             spill_it = globalVertexID
             t_spill = 0.
         else:
-            spill_it_tobj = event_spill_map.GetValue(f"{event.RunId} {event.EventId}")
-            spill_it = int(spill_it_tobj.GetName())
-            if spill_it != lastSpill: # New spill?
-                spillCounter += 1
-                lastSpill = spill_it
-            t_spill = spillCounter * spillPeriod_s * 1E6 # convert to us
+            spill_it = int(entry_spills[jentry - entry_start])
+            t_spill = float(entry_t_spill[jentry - entry_start])
 
         #print("event",event.EventId,"in spill",spill_it)
 
-        # write to file
-        if len(trajectories_list) >= 1000 or nb <= 0:
-            updateHDF5File(
-                output_file,
-                np.concatenate(trajectories_list, axis=0) if trajectories_list else np.empty((0,)),
-                np.concatenate(segments_list, axis=0) if segments_list else np.empty((0,)),
-                np.concatenate(vertices_list, axis=0) if vertices_list else np.empty((0,)),
-                np.concatenate(genie_stack_list, axis=0) if genie_stack_list else np.empty((0,)),
-                np.concatenate(genie_hdr_list, axis=0) if genie_hdr_list else np.empty((0,)))
+        # write to file, once flush_bytes of output (counting the GENIE block
+        # buffers) or block_size events are pending
+        if options["flush_bytes"]:
+            flush = pending_events > 0 and pending_bytes + genie_bytes >= options["flush_bytes"]
+        else:
+            flush = pending_events >= block_size
+        if flush or nb <= 0:
+            state["peak_buffered"] = max(state["peak_buffered"], pending_bytes + genie_bytes)
+            yield concatBatch(trajectories_list, segments_list, vertices_list,
+                              genie_stack_list, genie_hdr_list, pruning_list, containers_list), progress(jentry)
 
             trajectories_list = list()
             segments_list = list()
             vertices_list = list()
             genie_hdr_list = list()
             genie_stack_list = list()
+            pruning_list = list()
+            containers_list = list()
+            pending_bytes = 0
+            pending_events = 0
 
         if nb <= 0:
             continue
@@ -375,271 +1896,625 @@ def dump(input_file, output_file, keep_all_dets=False):
         #print("Class: ", event.ClassName())
         #print("Event number:", event.EventId)
 
-        # Count total number of vertices and trajectories
-        n_traj = 0
+        pending_events += 1
 
         # Dump the primary vertices
-        vertices = np.empty(len(event.Primaries), dtype=vertices_dtype)
-        for iVtx, primaryVertex in enumerate(event.Primaries):
-            #printPrimaryVertex("PP", primaryVertex)
-            vertices[iVtx]["event_id"] = spill_it
-            vertices[iVtx]["vertex_id"] = globalVertexID
-            vertices[iVtx]["x_vert"] = primaryVertex.GetPosition().X() * edep2cm
-            vertices[iVtx]["y_vert"] = primaryVertex.GetPosition().Y() * edep2cm
-            vertices[iVtx]["z_vert"] = primaryVertex.GetPosition().Z() * edep2cm
-            vertices[iVtx]["t_vert"] = primaryVertex.GetPosition().T() * edep2us
-            vertices[iVtx]["t_event"] = t_spill
-
-        vertices_list.append(vertices)
-
-        trackMap = {}
-
-        # Dump the trajectories
-        trajectories = np.full(len(event.Trajectories), np.iinfo(trajectories_dtype['traj_id']).max, dtype=trajectories_dtype)
-        for iTraj, trajectory in enumerate(event.Trajectories):
-            fileTrackID = trackCounter
-            trackCounter += 1
-            trackMap[trajectory.GetTrackId()] = fileTrackID
-
-            if trajectory.GetParentId() == -1:
-                start_pt, end_pt = trajectory.Points[0], trajectory.Points[-1]
-                trajectories[n_traj]["event_id"] = spill_it
-                trajectories[n_traj]["vertex_id"] = globalVertexID
-
-                trajectories[n_traj]["traj_id"] = trajectory.GetTrackId()
-                trajectories[n_traj]["file_traj_id"] = trackMap[trajectory.GetTrackId()]
-                trajectories[n_traj]["parent_id"] = trajectory.GetParentId()
-                trajectories[n_traj]["primary"] = True if trajectory.GetParentId() == -1 else False # primary particle parents trajectory id are -1
-
-                mass = trajectory.GetInitialMomentum().M()
-                p_start = (start_pt.GetMomentum().X(), start_pt.GetMomentum().Y(), start_pt.GetMomentum().Z())
-                p_end = (end_pt.GetMomentum().X(), end_pt.GetMomentum().Y(), end_pt.GetMomentum().Z())
-
-                trajectories[n_traj]["pxyz_start"] = p_start #(start_pt.GetMomentum().X(), start_pt.GetMomentum().Y(), start_pt.GetMomentum().Z())
-                trajectories[n_traj]["pxyz_end"] = p_end #(end_pt.GetMomentum().X(), end_pt.GetMomentum().Y(), end_pt.GetMomentum().Z())
-                trajectories[n_traj]["xyz_start"] = (start_pt.GetPosition().X() * edep2cm, start_pt.GetPosition().Y() * edep2cm, start_pt.GetPosition().Z() * edep2cm)
-                trajectories[n_traj]["xyz_end"] = (end_pt.GetPosition().X() * edep2cm, end_pt.GetPosition().Y() * edep2cm, end_pt.GetPosition().Z() * edep2cm)
-                trajectories[n_traj]["E_start"] = np.sqrt(np.sum(np.square(p_start)) + mass**2)
-                trajectories[n_traj]["E_end"] = np.sqrt(np.sum(np.square(p_end)) + mass**2)
-                trajectories[n_traj]["t_start"] = start_pt.GetPosition().T() * edep2us
-                trajectories[n_traj]["t_end"] = end_pt.GetPosition().T() * edep2us
-                trajectories[n_traj]["start_process"] = start_pt.GetProcess()
-                trajectories[n_traj]["start_subprocess"] = start_pt.GetSubprocess()
-                trajectories[n_traj]["end_process"] = end_pt.GetProcess()
-                trajectories[n_traj]["end_subprocess"] = end_pt.GetSubprocess()
-                trajectories[n_traj]["pdg_id"] = trajectory.GetPDGCode()
-                trajectories[n_traj]["dist_travel"]=0
-                for i in range(len(trajectory.Points)-1):
-                    trajectories[n_traj]["dist_travel"]+=(trajectory.Points[i].GetPosition()-trajectory.Points[i+1].GetPosition()).Vect().Mag()* edep2cm
-
-                n_traj += 1
-
-            else:
-                continue
-
-        # Dump the segment containers
+        if "vertices" in datasets:
+            with profile.phase("vertex_fill"):
+                vertices = np.empty(len(event.Primaries), dtype=vertices_dtype)
+                for iVtx, primaryVertex in enumerate(event.Primaries):
+                    #printPrimaryVertex("PP", primaryVertex)
+                    vertices[iVtx]["event_id"] = spill_it
+                    vertices[iVtx]["vertex_id"] = globalVertexID
+                    vertices[iVtx]["x_vert"] = primaryVertex.GetPosition().X() * edep2cm
+                    vertices[iVtx]["y_vert"] = primaryVertex.GetPosition().Y() * edep2cm
+                    vertices[iVtx]["z_vert"] = primaryVertex.GetPosition().Z() * edep2cm
+                    vertices[iVtx]["t_vert"] = primaryVertex.GetPosition().T() * edep2us
+                    vertices[iVtx]["t_event"] = t_spill
+
+                vertices_list.append(vertices)
+                pending_bytes += vertices.nbytes
+
+        # Unique-in-file track IDs, assigned in trajectory order
+        with profile.phase("ancestry"):
+            track_ids, parent_ids, track_pdg = packTrajectoryTable(event.Trajectories)
+            trackMap = dict(zip(track_ids.tolist(), range(trackCounter, trackCounter + len(track_ids))))
+            trackCounter += len(track_ids)
+
+        # Dump the segment containers, with the PDG code of each contributor,
+        # and collect the contributors for the ancestry
         #print("Number of segment containers:", event.SegmentDetectors.size())
-        for containerName, hitSegments in event.SegmentDetectors:
-            # If ARCUBE_ACTIVE_VOLUME is not set, default to previously hard
-            # coded containerName.
-            if (not keep_all_dets) and containerName != os.environ.get("ARCUBE_ACTIVE_VOLUME", "volTPCActive"):
-                continue
-            segment = np.empty(len(hitSegments), dtype=segments_dtype)
-            for iHit, hitSegment in enumerate(hitSegments):
-                segment[iHit]["event_id"] = spill_it
-                segment[iHit]["vertex_id"] = globalVertexID
-                segment[iHit]["segment_id"] = segment_id
-                segment_id += 1
-                try:
-                    segment[iHit]["traj_id"] = hitSegment.Contrib[0]
-                    segment[iHit]["file_traj_id"] = trackMap[hitSegment.Contrib[0]]
-                    seg_traj_id = hitSegment.Contrib[0]
-                    if segment[iHit]["traj_id"] not in trajectories["traj_id"]:
-                        # Given event.Trajectories is ordered by traj_id (trajectory.GetTrackId())
-                        trajectory = event.Trajectories[seg_traj_id]
-                        # Trace back in the family tree
-                        while trajectory.GetParentId() >= -1:
-                            if trajectory.GetTrackId() in trajectories["traj_id"]:
-                                if trajectory.GetParentId() == -1:
-                                    break
-                                else:
-                                    parent_traj_id = trajectory.GetParentId()
-                                    trajectory = event.Trajectories[parent_traj_id]
-                                continue
-
-                            start_pt, end_pt = trajectory.Points[0], trajectory.Points[-1]
-                            trajectories[n_traj]["event_id"] = spill_it
-                            trajectories[n_traj]["vertex_id"] = globalVertexID
-
-                            trajectories[n_traj]["traj_id"] = trajectory.GetTrackId()
-                            trajectories[n_traj]["file_traj_id"] = trackMap[trajectory.GetTrackId()]
-                            trajectories[n_traj]["parent_id"] = trajectory.GetParentId()
-                            trajectories[n_traj]["primary"] = True if trajectory.GetParentId() == -1 else False # primary particle parents trajectory id are -1
-
-                            mass = trajectory.GetInitialMomentum().M()
-                            p_start = (start_pt.GetMomentum().X(), start_pt.GetMomentum().Y(), start_pt.GetMomentum().Z())
-                            p_end = (end_pt.GetMomentum().X(), end_pt.GetMomentum().Y(), end_pt.GetMomentum().Z())
-
-                            trajectories[n_traj]["pxyz_start"] = p_start #(start_pt.GetMomentum().X(), start_pt.GetMomentum().Y(), start_pt.GetMomentum().Z())
-                            trajectories[n_traj]["pxyz_end"] = p_end #(end_pt.GetMomentum().X(), end_pt.GetMomentum().Y(), end_pt.GetMomentum().Z())
-                            trajectories[n_traj]["xyz_start"] = (start_pt.GetPosition().X() * edep2cm, start_pt.GetPosition().Y() * edep2cm, start_pt.GetPosition().Z() * edep2cm)
-                            trajectories[n_traj]["xyz_end"] = (end_pt.GetPosition().X() * edep2cm, end_pt.GetPosition().Y() * edep2cm, end_pt.GetPosition().Z() * edep2cm)
-                            trajectories[n_traj]["E_start"] = np.sqrt(np.sum(np.square(p_start)) + mass**2)
-                            trajectories[n_traj]["E_end"] = np.sqrt(np.sum(np.square(p_end)) + mass**2)
-                            trajectories[n_traj]["t_start"] = start_pt.GetPosition().T() * edep2us
-                            trajectories[n_traj]["t_end"] = end_pt.GetPosition().T() * edep2us
-                            trajectories[n_traj]["start_process"] = start_pt.GetProcess()
-                            trajectories[n_traj]["start_subprocess"] = start_pt.GetSubprocess()
-                            trajectories[n_traj]["end_process"] = end_pt.GetProcess()
-                            trajectories[n_traj]["end_subprocess"] = end_pt.GetSubprocess()
-                            trajectories[n_traj]["pdg_id"] = trajectory.GetPDGCode()
-                            trajectories[n_traj]["dist_travel"]=0
-                            for i in range(len(trajectory.Points)-1):
-                                trajectories[n_traj]["dist_travel"]+=(trajectory.Points[i].GetPosition()-trajectory.Points[i+1].GetPosition()).Vect().Mag()* edep2cm
-                            n_traj += 1
-                            if trajectories[n_traj-1]["parent_id"] == -1:
-                                break
-                            else:
-                                parent_traj_id = trajectory.GetParentId()
-                                trajectory = event.Trajectories[parent_traj_id]
-
-                except IndexError as e:
-                    print(e)
-                    print("iHit:",iHit)
-                    print("len(segment):",len(segment))
-                    print("hitSegment.Contrib[0]:",hitSegment.Contrib[0])
-                    print("len(trajectories):",len(trajectories))
-
-                segment[iHit]["x_start"] = hitSegment.GetStart().X() * edep2cm
-                segment[iHit]["y_start"] = hitSegment.GetStart().Y() * edep2cm
-                segment[iHit]["z_start"] = hitSegment.GetStart().Z() * edep2cm
-                segment[iHit]["t0_start"] = hitSegment.GetStart().T() * edep2us
-                segment[iHit]["t_start"] = 0
-                segment[iHit]["x_end"] = hitSegment.GetStop().X() * edep2cm
-                segment[iHit]["y_end"] = hitSegment.GetStop().Y() * edep2cm
-                segment[iHit]["z_end"] = hitSegment.GetStop().Z() * edep2cm
-                segment[iHit]["t0_end"] = hitSegment.GetStop().T() * edep2us
-                segment[iHit]["t_end"] = 0
-                segment[iHit]["dE"] = hitSegment.GetEnergyDeposit()
-                xd = segment[iHit]["x_end"] - segment[iHit]["x_start"]
-                yd = segment[iHit]["y_end"] - segment[iHit]["y_start"]
-                zd = segment[iHit]["z_end"] - segment[iHit]["z_start"]
-                dx = sqrt(xd**2 + yd**2 + zd**2)
-                segment[iHit]["dx"] = dx
-                segment[iHit]["x"] = (segment[iHit]["x_start"] + segment[iHit]["x_end"]) / 2.
-                segment[iHit]["y"] = (segment[iHit]["y_start"] + segment[iHit]["y_end"]) / 2.
-                segment[iHit]["z"] = (segment[iHit]["z_start"] + segment[iHit]["z_end"]) / 2.
-                segment[iHit]["t0"] = (segment[iHit]["t0_start"] + segment[iHit]["t0_end"]) / 2.
-                segment[iHit]["t"] = 0
-                segment[iHit]["dEdx"] = hitSegment.GetEnergyDeposit() / dx if dx > 0 else 0
-                segment[iHit]["pdg_id"] = trajectories[trajectories["traj_id"]==hitSegment.Contrib[0]]["pdg_id"]
-                segment[iHit]["n_electrons"] = 0
-                segment[iHit]["long_diff"] = 0
-                segment[iHit]["tran_diff"] = 0
-                segment[iHit]["pixel_plane"] = 0
-                segment[iHit]["n_photons"] = 0
-
-            segments_list.append(segment)
-        trajectories_list.append(trajectories[:n_traj])
+        event_contribs = list()
+        event_rules = list()
+        event_energies = list()
+        if "segments" in datasets or need_trajectories:
+            with profile.phase("segment_fill"):
+                trackPdg = dict(zip(track_ids.tolist(), track_pdg.tolist()))
+                for containerName, hitSegments in event.SegmentDetectors:
+                    # If ARCUBE_ACTIVE_VOLUME is not set, default to previously hard
+                    # coded containerName.
+                    if (not keep_all_dets) and containerName != os.environ.get("ARCUBE_ACTIVE_VOLUME", "volTPCActive"):
+                        continue
+                    start, stop, energy, contrib = packHitSegments(hitSegments)
+                    if options["prune"]:
+                        rule = pruneRule(start, stop, energy, options["prune"])
+                        event_rules.append(rule)
+                        event_energies.append(energy)
+                        keep = rule == len(prune_rules)
+                        start, stop, energy, contrib = start[keep], stop[keep], energy[keep], contrib[keep]
+                    event_contribs.append(contrib)
+                    if "segments" not in datasets:
+                        continue
+                    segment = fillSegments(start, stop, energy)
+                    segment["event_id"] = spill_it
+                    segment["vertex_id"] = globalVertexID
+                    segment["segment_id"] = np.arange(segment_id, segment_id + len(segment))
+                    if options["split_dets"]:
+                        containers_list.append(containerRow(spill_it, globalVertexID, str(containerName),
+                                                            segment_id, len(segment)))
+                        pending_bytes += containers_list[-1].nbytes
+                    segment_id += len(segment)
+                    segment["traj_id"] = contrib
+                    segment["file_traj_id"], segment["pdg_id"] = contributorIDs(contrib, trackMap, trackPdg)
+                    segments_list.append(segment)
+                    pending_bytes += segment.nbytes
+                if options["prune"]:
+                    pruning_list.append(pruningRow(event_rules, event_energies, spill_it))
+                    pending_bytes += pruning_list[-1].nbytes
+
+        # Dump the primary trajectories and the ancestry of every contributor
+        if need_trajectories:
+            with profile.phase("ancestry"):
+                contribs = np.concatenate(event_contribs) if event_contribs else np.empty((0,), dtype='i8')
+                order = resolveAncestry(track_ids, parent_ids, contribs)
+            with profile.phase("trajectory_fill"):
+                trajectories = fillTrajectories(*packTrajectories(event.Trajectories, order))
+                trajectories["event_id"] = spill_it
+                trajectories["vertex_id"] = globalVertexID
+                trajectories["file_traj_id"] = [trackMap[traj_id] for traj_id in track_ids[order].tolist()]
+                if "trajectories" in datasets:
+                    trajectories_list.append(trajectories)
+                    pending_bytes += trajectories.nbytes
 
         # Save truth information from GENIE
-        if genieTree:
-            genie_idx = 0
-            nu_4mom = np.empty((4,), dtype='f4')
-            lep_4mom = np.empty((4,), dtype='f4')
-            nu_pdg = 0
-            target_pdg = 0
-
-            # Create particle stack dataset
-            genie_stack = np.empty(genieTree.StdHepN, dtype=genie_stack_dtype)
-
-            for p in range(genieTree.StdHepN):
-
-                #Get only initial and final state particles
-                if genieTree.StdHepStatus[p] == 0 or genieTree.StdHepStatus[p] == 1:
-
-                    part_4mom = np.array([genieTree.StdHepP4[p*4 + 0]*gev2mev,
-                                        genieTree.StdHepP4[p*4 + 1]*gev2mev,
-                                        genieTree.StdHepP4[p*4 + 2]*gev2mev,
-                                        genieTree.StdHepP4[p*4 + 3]*gev2mev])
-                    part_pdg = genieTree.StdHepPdg[p]
-
-                    genie_stack[genie_idx]["event_id"] = spill_it
-                    genie_stack[genie_idx]["vertex_id"] = globalVertexID
-                    traj_id, file_traj_id = matchTrackID(trajectories_list[-1], part_4mom, part_pdg)
-                    genie_stack[genie_idx]["traj_id"] = traj_id
-                    genie_stack[genie_idx]["file_traj_id"] = file_traj_id
-                    genie_stack[genie_idx]["part_4mom"] = part_4mom
-                    genie_stack[genie_idx]["part_pdg"] = part_pdg
-                    genie_stack[genie_idx]["part_status"] = genieTree.StdHepStatus[p]
-
-                    #Get the incident neutrino four-vector
-                    if genieTree.StdHepStatus[p] == 0 and np.abs(genieTree.StdHepPdg[p]) in [12, 14, 16]:
-                        nu_4mom = np.array([genieTree.StdHepP4[p*4 + 0]*gev2mev,
-                                            genieTree.StdHepP4[p*4 + 1]*gev2mev,
-                                            genieTree.StdHepP4[p*4 + 2]*gev2mev,
-                                            genieTree.StdHepP4[p*4 + 3]*gev2mev])
-                        nu_pdg = genieTree.StdHepPdg[p]
-
-                    #Get the outgoing lepton four-vector
-                    if genieTree.StdHepStatus[p] == 1 and np.abs(genieTree.StdHepPdg[p]) in [11, 12, 13, 14, 15, 16]:
-                        lep_4mom = np.array([genieTree.StdHepP4[p*4 + 0]*gev2mev,
-                                            genieTree.StdHepP4[p*4 + 1]*gev2mev,
-                                            genieTree.StdHepP4[p*4 + 2]*gev2mev,
-                                            genieTree.StdHepP4[p*4 + 3]*gev2mev])
-                        lep_pdg = genieTree.StdHepPdg[p]
-
-                    #Get the struck nucleus pdg code
-                    if genieTree.StdHepStatus[p] == 0 and np.abs(genieTree.StdHepPdg[p]) not in [12, 14, 16]:
-                        target_pdg = genieTree.StdHepPdg[p]
-
-                    genie_idx += 1
-
-            #Shrink the array to remove used space
-            genie_stack.resize((genie_idx,))
-            genie_stack_list.append(genie_stack)
-
-            #Fun fact: EvtCode is a TObjString. Use GetString and Data methods to get Python string
-            genie_str = genieTree.EvtCode.GetString().Data()
-
-            #Create GENIE header/summary dataset
-            genie_hdr = np.empty(1, dtype=genie_hdr_dtype)
-            genie_hdr["event_id"] = spill_it
-            genie_hdr["vertex_id"] = globalVertexID
-            genie_hdr["isCC"]  = "CC" in genie_str
-            genie_hdr["isQES"] = "QES" in genie_str
-            genie_hdr["isMEC"] = "MEC" in genie_str
-            genie_hdr["isRES"] = "RES" in genie_str
-            genie_hdr["isDIS"] = "DIS" in genie_str
-            genie_hdr["isCOH"] = "COH" in genie_str
-            genie_hdr["reaction"] = getReactionCode(genie_str)
-            genie_hdr["x_vert"] = genieTree.EvtVtx[0]*meter2cm
-            genie_hdr["y_vert"] = genieTree.EvtVtx[1]*meter2cm
-            genie_hdr["z_vert"] = genieTree.EvtVtx[2]*meter2cm
-            genie_hdr["t_vert"] = genieTree.EvtVtx[3]*edep2us
-            genie_hdr["target"] = int((target_pdg % 10000000) / 10000) #Extract Z value from PDG code
-            genie_hdr["Enu"] = nu_4mom[3]
-            genie_hdr["nu_4mom"] = nu_4mom
-            genie_hdr["nu_pdg"] = nu_pdg
-            genie_hdr["Elep"] = lep_4mom[3]
-            genie_hdr["lep_mom"] = np.linalg.norm(lep_4mom[0:3])
-            genie_hdr["lep_ang"] = np.arccos(lep_4mom[0:3].dot(beam_dir) / (beam_norm * genie_hdr["lep_mom"])) * (180.0 / np.pi) # degrees
-            genie_hdr["lep_pdg"] = lep_pdg
-            genie_hdr["q0"] = nu_4mom[3] - lep_4mom[3]
-            genie_hdr["q3"] = np.linalg.norm(nu_4mom[0:3] - lep_4mom[0:3])
-            genie_hdr["Q2"] = genie_hdr["q3"]**2 - genie_hdr["q0"]**2
-            genie_hdr["x"]  = genie_hdr["Q2"] / (2.0 * nucleon_mass * genie_hdr["q0"])
-            genie_hdr["y"]  = 1.0 - (genie_hdr["Elep"] / genie_hdr["Enu"])
-            genie_hdr_list.append(genie_hdr)
+        if need_genie and "mc_stack" in datasets:
+            with profile.phase("genie_stack"):
+                p_first, p_last = genie["genie_offsets"][iGenie], genie["genie_offsets"][iGenie+1]
+                genie_stack = fillGenieStack(genie["stdhep_status"][p_first:p_last], genie["stdhep_pdg"][p_first:p_last],
+                                             genie["stdhep_p4"][p_first:p_last], trajectories, options)
+                genie_stack["event_id"] = spill_it
+                genie_stack["vertex_id"] = globalVertexID
+                genie_stack_list.append(genie_stack)
+                pending_bytes += genie_stack.nbytes
+
+        if need_genie and "mc_hdr" in datasets:
+            with profile.phase("genie_header"):
+                genie_hdr = genie_hdrs[[iGenie]]
+                genie_hdr["event_id"] = spill_it
+                genie_hdr["vertex_id"] = globalVertexID
+                genie_hdr_list.append(genie_hdr)
+                pending_bytes += genie_hdr.nbytes
 
     # save any lingering data not written to file
-    updateHDF5File(
-        output_file,
-        np.concatenate(trajectories_list, axis=0) if trajectories_list else np.empty((0,)),
-        np.concatenate(segments_list, axis=0) if segments_list else np.empty((0,)),
-        np.concatenate(vertices_list, axis=0) if vertices_list else np.empty((0,)),
-        np.concatenate(genie_stack_list, axis=0) if genie_stack_list else np.empty((0,)),
-        np.concatenate(genie_hdr_list, axis=0) if genie_hdr_list else np.empty((0,)))
+    state.update(segment_id=segment_id, trackCounter=trackCounter,
+                 peak_buffered=max(state["peak_buffered"], pending_bytes + genie_bytes))
+    yield concatBatch(trajectories_list, segments_list, vertices_list,
+                      genie_stack_list, genie_hdr_list, pruning_list, containers_list), snapshotState(state, entry_stop)
+
+# Open an input file. Returns the TFile (which owns the trees), the edep-sim
+# and GENIE trees, the event to spill map (see readSpillMap; None if there is
+# no event_spill_map) and the spill period.
+def openInput(input_file):
+    # Get the input tree out of the file.
+    inputFile = TFile(input_file)
+    inputTree = inputFile.Get("EDepSimEvents")
+    genieTree = inputFile.Get("DetSimPassThru/gRooTracker")
+    # print("Class: ", inputTree.ClassName())
+    # print("Class: ", genieTree.ClassName())
+
+    # IF CRASH: Uncomment this section (also see IF CRASH below)
+    # Attach a brach to the events.
+    # event = TG4Event()
+    # inputTree.SetBranchAddress("Event",event)
+
+    # map that gives which spill each event lives in
+    event_spill_map = inputFile.Get("event_spill_map")
+
+    if not event_spill_map:
+        spill_map = None
+        spillPeriod_s = 0.
+    else:
+        spill_map = readSpillMap(event_spill_map)
+        spillPeriod_s = inputFile.Get("spillPeriod_s").GetVal()
+
+    return inputFile, inputTree, genieTree, spill_map, spillPeriod_s
+
+# Split the entries of a file into at most nproc contiguous shards of similar
+# size, cutting only where a new spill starts. Returns a list of (entry_start,
+# entry_stop, spillCounter), where spillCounter is the spill counter just
+# before entry_start.
+def shardEntries(inputTree, spill_map, entries, nproc):
+    if spill_map is None:
+        # Every event is its own spill
+        starts = np.arange(entries)
+    else:
+        spills = lookupSpills(spill_map, *readEventIds(inputTree, 0, entries))
+        starts = np.nonzero(np.diff(spills, prepend=spills[0]-1) != 0)[0]
+
+    targets = np.arange(1, nproc) * entries / nproc
+    cuts = starts[np.minimum(np.searchsorted(starts, targets), len(starts)-1)]
+    cuts = sorted(set([0, entries] + [int(cut) for cut in cuts]))
+    return [(start, stop, int(np.searchsorted(starts, start)) - 1)
+            for start, stop in zip(cuts[:-1], cuts[1:])]
+
+# Convert one shard of a file into its own output file, as a worker process.
+# Returns the final counters of the shard.
+def dumpShard(input_file, shard_file, keep_all_dets, engine, block_size, queue_depth,
+              entry_start, entry_stop, spillCounter, options):
+    global profile
+    profile = Profiler(options["profile"])
+
+    inputFile, inputTree, genieTree, spill_map, spillPeriod_s = openInput(input_file)
+    state = dict(segment_id=0, trackCounter=0, spillCounter=spillCounter, lastSpill=None,
+                 evtcodes=dict() if options["evtcode_table"] else None, peak_buffered=0)
+
+    with HDF5Writer(shard_file, dtypes=outputDtypes(options), groups=outputGroups(options)) as writer:
+        dumpEntries(inputTree, genieTree, writer, engine, keep_all_dets, block_size, queue_depth,
+                    spill_map, spillPeriod_s, entry_start, entry_stop, state, options)
+    state["profile"] = profile.totals()
+    return state
+
+# Append shard outputs to the writer in order. The segment_id and
+# file_traj_id counters of each shard start from zero, so they are shifted by
+# the final counters of all preceding shards; unmatched mc_stack entries keep
+# their -999 and segments without a known contributor their fill value.
+def mergeShards(writer, shard_files, shard_states, state, step=1000000):
+    missing_traj_id = np.iinfo(segments_dtype['file_traj_id']).max
+    segment_offset = 0
+    track_offset = 0
+    for shard_file, shard_state in zip(shard_files, shard_states):
+        # Row in the merged mc_evtcode table of each row of the shard's
+        if state["evtcodes"] is not None:
+            evtcode_rows = np.array([state["evtcodes"].setdefault(code, len(state["evtcodes"]))
+                                     for code in shard_state["evtcodes"]], dtype='i4')
+        # The ancestry index and segment_containers of the shard refer to rows
+        # of the shard's own datasets
+        row_offsets = dict(writer.rows)
+        traj_row_offset = row_offsets.get("trajectories", 0)
+        children_offset = row_offsets.get("traj_children", 0)
+
+        with h5py.File(shard_file, 'r') as f:
+            for name in writer.dtypes:
+                if name not in f or name == 'spill_index':
+                    continue
+                paths = [f"{name}/{key}" for key in f[name]] if name in writer.groups else [name]
+                for path in paths:
+                    for start in range(0, len(f[path]), step):
+                        rows = f[path][start:start+step]
+                        columns = rows.dtype.names
+                        if name == 'segments' and "segment_id" in columns:
+                            rows["segment_id"] += segment_offset
+                        if name in ['segments', 'trajectories'] and "file_traj_id" in columns:
+                            rows["file_traj_id"][rows["file_traj_id"] != missing_traj_id] += track_offset
+                        if name == 'mc_stack' and "file_traj_id" in columns:
+                            rows["file_traj_id"][rows["file_traj_id"] != -999] += track_offset
+                        if name == 'mc_hdr' and state["evtcodes"] is not None and "evt_code" in columns:
+                            rows["evt_code"] = evtcode_rows[rows["evt_code"]]
+                        if name == 'traj_index':
+                            rows["parent_row"][rows["parent_row"] != -1] += traj_row_offset
+                            rows["children"]["start"] += children_offset
+                            rows["children"]["stop"] += children_offset
+                        if name == 'traj_children':
+                            rows["traj_row"] += traj_row_offset
+                        if name == 'segment_index':
+                            rows["traj_row"][rows["traj_row"] != -1] += traj_row_offset
+                        if name == 'segment_containers':
+                            rows["first_segment_id"] += segment_offset
+                            for detector in np.unique(rows["detector"]):
+                                offset = row_offsets.get(f"segments/{detector.decode()}", 0)
+                                rows["rows"]["start"][rows["detector"] == detector] += offset
+                                rows["rows"]["stop"][rows["detector"] == detector] += offset
+                        writer.append(path, rows)
+        segment_offset += shard_state["segment_id"]
+        track_offset += shard_state["trackCounter"]
+
+# A ProcessPoolExecutor of `workers` processes, spawned rather than forked so
+# that they start without the parent's ROOT state. Python 3.6 can't choose
+# how the pool starts its processes, so there they are forked.
+def spawnedPool(workers):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    if sys.version_info < (3, 7):
+        return ProcessPoolExecutor(workers)
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+
+# Convert a file with nproc worker processes, one per shard, and merge the
+# shards into the writer
+def dumpSharded(input_file, writer, output_file, keep_all_dets, engine, block_size, queue_depth,
+                inputTree, spill_map, entries, nproc, state, options):
+    from concurrent.futures.process import BrokenProcessPool
+
+    shards = shardEntries(inputTree, spill_map, entries, nproc)
+    shard_files = [f"{output_file}.shard{i}" for i in range(len(shards))]
+    try:
+        with spawnedPool(len(shards)) as executor:
+            futures = [executor.submit(dumpShard, input_file, shard_file, keep_all_dets, engine,
+                                       block_size, queue_depth, entry_start, entry_stop, spillCounter, options)
+                       for shard_file, (entry_start, entry_stop, spillCounter) in zip(shard_files, shards)]
+            try:
+                shard_states = [future.result() for future in futures]
+            except BrokenProcessPool as e:
+                # A worker died (e.g. segfaulted in ROOT) rather than raising
+                raise RuntimeError(f"A worker converting a shard of {input_file} died") from e
+        for shard_state in shard_states:
+            profile.merge(shard_state.pop("profile"))
+        with profile.phase("hdf5_write"):
+            mergeShards(writer, shard_files, shard_states, state)
+    finally:
+        for shard_file in shard_files:
+            if os.path.exists(shard_file):
+                os.remove(shard_file)
+
+# Read a file and dump it.
+def dump(input_file, output_file, keep_all_dets=False, engine="root", block_size=1000,
+         chunk_size=None, rdcc_nbytes=None, rdcc_nslots=None, nproc=1, queue_depth=0,
+         compression="none", shuffle=False, match_rtol=1e-05, match_atol=1e-08, beam_dir=beam_dir,
+         evtcode_table=False, checkpoint=False, spill_index=True, flush_bytes=None, profile_phases=False,
+         packed=False, datasets=None, columns=None, spill_chunk_bytes=None, ancestry_index=False,
+         min_dE=None, region=None, t0_window=None, split_dets=False):
+
+    """
+    Script to convert edep-sim root output to an h5 file formatted in a way
+    that larnd-sim expects for consumption.
+
+    Args:
+        input_file (str): path to an input ROOT file containing spills.
+        output_file (str): name of the h5 output file to which the information should
+            be written
+        keep_all_dets (bool): keep segments from every SegmentDetectors
+            container, not just ARCUBE_ACTIVE_VOLUME
+        engine (str): "root" to read the input one entry at a time with PyROOT,
+            or "bulk" to read it in blocks of entries, each copied into flat
+            arrays by a single compiled call, and convert each block at once.
+            Both produce identical datasets.
+        block_size (int): number of entries per block read by the "bulk"
+            engine; the "root" engine reads the GENIE tree in blocks of
+            block_size entries and writes every block_size events
+        chunk_size (int, str or dict): HDF5 chunk length in rows, or a preset
+            ("small", "medium" or "large": 64 kiB, 1 MiB or 8 MiB chunks), for
+            all datasets or as {dataset: value}. Default: chosen by h5py
+        rdcc_nbytes (int): HDF5 chunk cache size in bytes. Default: HDF5 default
+        rdcc_nslots (int): number of HDF5 chunk cache slots. Default: HDF5 default
+        nproc (int): number of worker processes. With more than one, the
+            entries are split into shards at spill boundaries, converted in
+            parallel and merged into output identical to a serial run
+        queue_depth (int): if > 0, read, convert and write in separate
+            threads connected by queues of this many blocks, and print how
+            long each stage was blocked. Default: run them in turn
+        compression (str or dict): "none", "gzip[:level]", "lzf" or
+            "blosc[:compressor[:level]]" (needs hdf5plugin, also to read the
+            output), for all datasets or as {dataset: value}
+        shuffle (bool or dict): apply the byte shuffle filter before compression
+        match_rtol (float): relative tolerance on each 4-momentum component
+            when matching GENIE particles to primary trajectories
+        match_atol (float): absolute tolerance (MeV) for the same
+        beam_dir (list): beam direction (x, y, z) from which the lepton angle
+            in mc_hdr is measured; need not be normalised
+        evtcode_table (bool): also write the mc_evtcode dataset, with one row
+            per distinct GENIE EvtCode string and its classification, and an
+            evt_code field in mc_hdr with the row of each event's EvtCode
+        checkpoint (bool): after every write, record in the output file how
+            far the conversion got. If output_file already holds such a
+            checkpoint, carry on from it instead of starting again; the
+            result is identical to an uninterrupted run. Needs nproc=1 and
+            the same input file and options as the interrupted run. HDF5
+            files are only consistent between writes, so this covers runs
+            stopped between them (e.g. killed at a batch-job time limit
+            while converting); one killed in the middle of a write can leave
+            an unreadable file, to be removed before running again
+        spill_index (bool): write the spill_index dataset, with the [start,
+            stop) rows of each spill (event_id) in every other dataset
+        flush_bytes (int): write out the pending output arrays once they
+            reach this many bytes, rather than every block_size events; the
+            "bulk" engine instead sizes its blocks so that the raw input,
+            intermediate and output arrays of the queue_depth + 2 blocks in
+            flight fit in this many bytes. The peak size of the buffered
+            arrays is printed at the end. Default: no byte budget
+        profile_phases (bool): time each phase of the conversion (reading,
+            spill lookup, filling each dataset, ancestry, HDF5 writing) and
+            write the times and call counts, the rows per second of each
+            dataset and the peak resident memory to output_file.profile.json.
+            With nproc > 1 the phase times are summed over the workers
+        packed (bool): write trajectories, segments, vertices, mc_stack and
+            mc_hdr without alignment padding, and segments without the
+            placeholder fields larnd-sim fills in (t_start, t_end, t,
+            n_electrons, long_diff, tran_diff, pixel_plane, n_photons). Each
+            of these datasets records its full layout in a full_dtype
+            attribute, from which read_edepsim_h5.py rebuilds the usual rows
+        datasets (list or str): the datasets to write (a list, or separated
+            by commas), among trajectories, segments, vertices, mc_stack and
+            mc_hdr. The work feeding only the others is
+            skipped (e.g. without trajectories and mc_stack, the trajectory
+            points aren't read and no ancestry is traced). Default: all
+        columns (dict): {dataset: [column, ...]}, to write only these columns
+            (and event_id) of some datasets. Default: all columns
+        spill_chunk_bytes (int or str): align the HDF5 chunks of trajectories,
+            segments, vertices, mc_stack and mc_hdr to spills: each chunk
+            holds whole spills, up to this many bytes (or a chunk_size
+            preset), so reading a spill only reads the chunk(s) holding it.
+            The datasets are then virtual datasets joining the chunks, which
+            are stored under spill_chunks/. Overrides chunk_size for these
+            datasets; can't be combined with checkpoint. Default: off
+        ancestry_index (bool): also write traj_index, with the row of the
+            parent of each trajectories row (-1 for primaries) and the
+            [start, stop) rows of traj_children listing the rows of its
+            children, and segment_index, with the trajectories row of the
+            trajectory contributing each segments row. Needs trajectories
+        min_dE (float): drop hit segments depositing less than this (MeV)
+        region (list or str): drop hit segments whose midpoint lies outside
+            every box of this list of [[xmin, xmax], [ymin, ymax], [zmin,
+            zmax]] (cm), e.g. one box per TPC, or a JSON file holding it
+        t0_window (list): drop hit segments whose t0 lies outside [min, max)
+            (us from the start of the spill). With min_dE, region or
+            t0_window, segments are pruned before their IDs and the
+            trajectory ancestry are assigned, and the segment_pruning dataset
+            gives for each spill the number and energy of the segments
+            dropped by each rule (the first one they fail) and of those
+            kept; its rules attribute records the rules. Needs segments
+        split_dets (bool): write the segments of each SegmentDetectors
+            container (e.g. with keep_all_dets) to its own dataset,
+            segments/<container>, rather than all to segments; segment_id
+            still counts across all of them. The segment_containers dataset
+            gives for each container of each event its name, first
+            segment_id and [start, stop) rows in segments/<container>, and
+            takes the place of segments in spill_index. With ancestry_index,
+            segment_index is split the same way. Needs segments; can't be
+            combined with checkpoint
+    """
+
+    if engine not in ["root", "bulk"]:
+        raise ValueError(f"Unknown engine {engine}, expected 'root' or 'bulk'")
+    if checkpoint and nproc > 1:
+        raise ValueError("checkpoint is only supported with nproc=1")
+    if checkpoint and spill_chunk_bytes:
+        raise ValueError("checkpoint can't be combined with spill_chunk_bytes")
+    if checkpoint and split_dets:
+        raise ValueError("checkpoint can't be combined with split_dets")
+    datasets = list(output_dtypes) if datasets is None else datasets.split(",") if isinstance(datasets, str) else list(datasets)
+    columns = dict(columns or dict())
+    for name in datasets:
+        if name not in output_dtypes:
+            raise ValueError(f"Unknown dataset {name}, expected some of {list(output_dtypes)}")
+    for name, names in columns.items():
+        if name not in datasets:
+            raise ValueError(f"Columns given for {name}, which is not among the datasets written")
+        dtype = genie_hdr_evtcode_dtype if name == "mc_hdr" and evtcode_table else output_dtypes[name]
+        for column in names:
+            if column not in dtype.names:
+                raise ValueError(f"Unknown column {column} of {name}, expected one of {dtype.names}")
+    if ancestry_index and "trajectories" not in datasets:
+        raise ValueError("ancestry_index needs the trajectories dataset")
+    prune = dict()
+    if min_dE is not None:
+        prune["min_dE"] = float(min_dE)
+    if region is not None:
+        if isinstance(region, str):
+            with open(region) as f:
+                region = json.load(f)
+        region = np.asarray(region, dtype='f8')
+        if region.ndim == 2:
+            region = region[np.newaxis]
+        if region.ndim != 3 or region.shape[1:] != (3, 2):
+            raise ValueError(f"Expected region as boxes of [[xmin, xmax], [ymin, ymax], [zmin, zmax]], got {region.tolist()}")
+        prune["region"] = region.tolist()
+    if t0_window is not None:
+        if len(t0_window) != 2:
+            raise ValueError(f"Expected t0_window as [min, max], got {t0_window}")
+        prune["t0_window"] = [float(t) for t in t0_window]
+    if prune and "segments" not in datasets:
+        raise ValueError("min_dE, region and t0_window need the segments dataset")
+    if split_dets and "segments" not in datasets:
+        raise ValueError("split_dets needs the segments dataset")
+    evtcode_table = evtcode_table and "mc_hdr" in datasets
+
+    global profile
+    profile = Profiler(profile_phases)
+
+    inputFile, inputTree, genieTree, spill_map, spillPeriod_s = openInput(input_file)
+
+    # Read all of the events.
+    entries = inputTree.GetEntriesFast()
+
+    # Conversion options, passed down to convertROOT()/convertBlock()
+    options = dict(match_rtol=match_rtol, match_atol=match_atol,
+                   beam_dir=np.asarray(beam_dir, dtype='f8'), evtcode_table=evtcode_table,
+                   checkpoint=checkpoint, spill_index=spill_index,
+                   flush_bytes=int(flush_bytes) if flush_bytes else None, profile=profile_phases,
+                   packed=packed, datasets=datasets, columns=columns, ancestry_index=ancestry_index,
+                   prune=prune or None, split_dets=split_dets)
+
+    # Everything besides the datasets that the rows written depend on, which a
+    # checkpoint must have been written with to be resumed
+    conversion = dict(input_file=os.path.abspath(input_file), entry_start=0, entry_stop=entries,
+                      keep_all_dets=bool(keep_all_dets), match_rtol=match_rtol, match_atol=match_atol,
+                      beam_dir=options["beam_dir"].tolist(), evtcode_table=evtcode_table,
+                      spill_index=spill_index, packed=packed, datasets=datasets, columns=columns,
+                      ancestry_index=ancestry_index, prune=options["prune"])
+
+    # Prep output file
+    with HDF5Writer(output_file, chunk_size, rdcc_nbytes, rdcc_nslots,
+                    compression=compression, shuffle=shuffle, dtypes=outputDtypes(options),
+                    checkpoint=checkpoint, spill_chunk_bytes=spill_chunk_bytes,
+                    groups=outputGroups(options), conversion=conversion) as writer:
+        if packed:
+            full_dtypes = outputDtypes(dict(options, packed=False))
+            for name in datasets:
+                writer.file[name].attrs["full_dtype"] = dtypeJSON(full_dtypes[name])
+        if prune:
+            writer.file["segment_pruning"].attrs["rules"] = json.dumps(prune)
+
+        if genieTree:
+            genie_entries = genieTree.GetEntriesFast()
+
+            # Check that the edep-sim and GENIE trees have the same number of events
+            if entries != genie_entries:
+                raise ValueError(f"Edep-sim tree and GENIE tree number of entries do not match! "
+                                 f"({entries} vs {genie_entries})")
+
+        state = dict(segment_id=0, trackCounter=0, spillCounter=-1, lastSpill=None,
+                     evtcodes=dict() if evtcode_table else None, peak_buffered=0)
+        entry_start = 0
+        if writer.checkpoint is not None:
+            entry_start = writer.checkpoint.pop("entry")
+            if entry_start > entries:
+                raise ValueError(f"Checkpoint of {output_file} is at entry {entry_start}, "
+                                 f"but {input_file} has only {entries} entries")
+            state.update(writer.checkpoint)
+            print(f"Resuming {output_file} from entry {entry_start}")
+
+        if nproc > 1 and entries > 0:
+            dumpSharded(input_file, writer, output_file, keep_all_dets, engine, block_size, queue_depth,
+                        inputTree, spill_map, entries, nproc, state, options)
+        elif entry_start < entries:
+            dumpEntries(inputTree, genieTree, writer, engine, keep_all_dets, block_size, queue_depth,
+                        spill_map, spillPeriod_s, entry_start, entries, state, options)
+
+        if evtcode_table:
+            writer.append("mc_evtcode", evtcodeTable(state["evtcodes"]))
+
+    if profile_phases:
+        profile.write(output_file + ".profile.json", writer.rows,
+                      dict(input_file=input_file, engine=engine, nproc=nproc, block_size=block_size,
+                           queue_depth=queue_depth, entries=entries - entry_start))
+
+# (input, output) pairs of a batch: from a list of input files, a directory
+# (its .root files) or a manifest with one "input [output]" per line. Missing
+# outputs are named after the inputs, in output_dir or next to them.
+def batchFiles(inputs, output_dir):
+    if isinstance(inputs, str) and os.path.isdir(inputs):
+        lines = sorted(glob.glob(os.path.join(inputs, "*.root")))
+    elif isinstance(inputs, str):
+        with open(inputs) as f:
+            lines = [line.split('#')[0].strip() for line in f]
+    else:
+        lines = list(inputs)
+
+    files = []
+    for line in lines:
+        if not line:
+            continue
+        fields = line.split()
+        if len(fields) > 2:
+            raise ValueError(f"Expected 'input [output]' in batch manifest, got '{line}'")
+        if len(fields) == 1:
+            name = os.path.basename(fields[0])
+            for suffix in [".root", ".EDEPSIM_SPILLS", ".EDEPSIM"]:
+                name = name[:-len(suffix)] if name.endswith(suffix) else name
+            fields.append(os.path.join(output_dir or os.path.dirname(fields[0]), name + ".EDEPSIM.hdf5"))
+        files.append(tuple(fields))
+    return files
+
+# Convert one file of a batch, returning (input, output, status, error), with
+# status 0 on success and 1 on failure. Unless checkpointing, the partial
+# output of a failed conversion is removed.
+def dumpBatchFile(input_file, output_file, options):
+    try:
+        dump(input_file, output_file, **options)
+        return input_file, output_file, 0, None
+    except Exception as e:
+        traceback.print_exc()
+        if os.path.exists(output_file) and not options.get("checkpoint"):
+            os.remove(output_file)
+        return input_file, output_file, 1, f"{type(e).__name__}: {e}"
+
+# Send the result of dumpBatchFile() over a multiprocessing connection
+def sendBatchFile(connection, input_file, output_file, options):
+    connection.send(dumpBatchFile(input_file, output_file, options))
+    connection.close()
+
+# Convert one file of a batch in a process of its own, returning the result of
+# dumpBatchFile(), or, if the process dies (e.g. segfaults in ROOT), its exit
+# code (-signal) as the status
+def dumpBatchFileIsolated(input_file, output_file, options):
+    import multiprocessing
+
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=sendBatchFile, args=(sender, input_file, output_file, options))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is not None:
+        return result
+    if os.path.exists(output_file) and not options.get("checkpoint"):
+        os.remove(output_file)
+    return input_file, output_file, process.exitcode or 1, f"Conversion process died with exit code {process.exitcode}"
+
+def dumpBatch(inputs, output_dir=None, workers=1, status_file=None, **options):
+
+    """
+    Convert many files in a pool of worker processes, paying for starting
+    Python, ROOT and the TG4Event dictionary only once per worker. A failure
+    converting one file doesn't stop the others, even if it kills its worker
+    (e.g. a segfault in ROOT): the files the dead pool was converting or had
+    yet to convert are then converted again, each in a process of its own.
+    Exits with status 1 if any file failed.
+
+    Args:
+        inputs (str or list): a list of input files, a directory (every .root
+            file in it) or a manifest file with one "input [output]" per line
+            (blank lines and # comments are skipped)
+        output_dir (str): where to write outputs not named in the manifest, as
+            <input name>.EDEPSIM.hdf5. Default: next to each input
+        workers (int): convert this many files at a time. Needs nproc=1 if > 1
+        status_file (str): also write the status (0 on success, 1 on an
+            error, or the exit code of a conversion process that died, e.g.
+            -11 for a segfault) and error of every file to this JSON file
+        options: any other argument of dump(), applied to every file
+    """
+
+    if workers > 1 and options.get("nproc", 1) > 1:
+        raise ValueError("workers > 1 needs nproc=1")
+    files = batchFiles(inputs, output_dir)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    from concurrent.futures.process import BrokenProcessPool
+
+    # A worker dying breaks the whole pool, failing every file not yet
+    # converted; those are converted again one process each, so that only
+    # the file that kills its process fails
+    results = list()
+    with spawnedPool(workers) as executor:
+        futures = [executor.submit(dumpBatchFile, input_file, output_file, options)
+                   for input_file, output_file in files]
+        for (input_file, output_file), future in zip(files, futures):
+            try:
+                results.append(future.result())
+            except BrokenProcessPool:
+                results.append(dumpBatchFileIsolated(input_file, output_file, options))
+
+    failed = [result for result in results if result[2]]
+    for input_file, output_file, status, error in failed:
+        print(f"Failed to convert {input_file}: {error}")
+    print(f"Converted {len(results) - len(failed)} of {len(results)} files")
+
+    if status_file:
+        with open(status_file, 'w') as f:
+            json.dump([dict(input_file=input_file, output_file=output_file, status=status, error=error)
+                       for input_file, output_file, status, error in results], f, indent=4)
+            f.write('\n')
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
-    fire.Fire(dump)
+    # "convert_edepsim_roottoh5.py batch ..." converts many files, see dumpBatch()
+    if sys.argv[1:2] == ["batch"]:
+        fire.Fire(dumpBatch, sys.argv[2:], name="batch")
+    else:
+        fire.Fire(dump)
@@ -0,0 +1,103 @@
+#! /usr/bin/env python3
+"""
+Reads EDEPSIM_H5 files in the full (larnd-sim) or the packed layout written
+by convert_edepsim_roottoh5.py, without needing ROOT
+"""
+
+import json
+import numpy as np
+import fire
+import h5py
+
+# dtype from the JSON of its fields, offsets and size, as kept in the
+# full_dtype attribute of packed datasets
+def jsonDtype(text):
+    spec = json.loads(text)
+    formats = [(base, tuple(shape)) if shape else base for base, shape in spec["formats"]]
+    return np.dtype(dict(names=spec["names"], formats=formats, offsets=spec["offsets"],
+                         itemsize=spec["itemsize"]), align=True)
+
+# The full, larnd-sim-compatible dtype of a dataset: its own, unless it was
+# written in the packed layout
+def fullDtype(dset):
+    if "full_dtype" not in dset.attrs:
+        return dset.dtype
+    return jsonDtype(dset.attrs["full_dtype"])
+
+# Rows in the full layout, with the fields they lack (placeholders) zero
+def unpackRows(rows, dtype):
+    full = np.zeros(len(rows), dtype=dtype)
+    for name in rows.dtype.names:
+        full[name] = rows[name]
+    return full
+
+# Read-only view of a dataset in either layout, indexed like an h5py dataset,
+# that gives its rows in the full layout
+class FullView:
+    def __init__(self, dset):
+        self.dset = dset
+        self.dtype = fullDtype(dset)
+        self.packed = "full_dtype" in dset.attrs
+
+    def __len__(self):
+        return len(self.dset)
+
+    @property
+    def shape(self):
+        return self.dset.shape
+
+    def __getitem__(self, sel):
+        if isinstance(sel, str):
+            return self[:][sel]
+        rows = self.dset[sel]
+        if not self.packed:
+            return rows
+        if np.ndim(rows) == 0:
+            return unpackRows(rows[np.newaxis], self.dtype)[0]
+        return unpackRows(rows, self.dtype)
+
+# Paths of the datasets of a file, including those in groups (segments/<container>
+# with split_dets), but not the pieces of spill-aligned datasets
+def datasetNames(f):
+    names = list()
+    f.visititems(lambda name, obj: names.append(name) if isinstance(obj, h5py.Dataset)
+                 and not name.startswith("spill_chunks/") else None)
+    return names
+
+# Open an EDEPSIM_H5 file, returning the h5py file and a FullView of each
+# dataset, by path. The file is left for the caller to close.
+def openFull(input_file):
+    f = h5py.File(input_file, 'r')
+    return f, {name: FullView(f[name]) for name in datasetNames(f)}
+
+# Rewrite a packed file in the full layout, for readers that open the datasets
+# directly
+def unpack(input_file, output_file, step=1000000):
+
+    """
+    Rewrite an EDEPSIM_H5 file written with --packed in the full layout that
+    larnd-sim expects; datasets already in the full layout are copied as is.
+    Virtual (spill-aligned) datasets are rewritten as ordinary ones. Datasets
+    in groups (segments/<container>) keep their paths.
+
+    Args:
+        input_file (str): EDEPSIM_H5 file, as written by convert_edepsim_roottoh5.py
+        output_file (str): the rewritten file
+        step (int): rows rewritten at a time
+    """
+
+    with h5py.File(input_file, 'r') as fin, h5py.File(output_file, 'w') as fout:
+        for name in datasetNames(fin):
+            if "full_dtype" not in fin[name].attrs and not fin[name].is_virtual:
+                fin.copy(name, fout.require_group(fin[name].parent.name), name=name.split("/")[-1])
+                continue
+            view = FullView(fin[name])
+            dset = fout.create_dataset(name, (len(view),), dtype=view.dtype, maxshape=(None,),
+                                       chunks=fin[name].chunks or True, compression=fin[name].compression,
+                                       compression_opts=fin[name].compression_opts, shuffle=fin[name].shuffle)
+            dset.attrs.update({key: val for key, val in fin[name].attrs.items() if key != "full_dtype"})
+            for start in range(0, len(view), step):
+                dset[start:start+step] = view[start:start+step]
+
+if __name__ == "__main__":
+    fire.Fire(unpack)
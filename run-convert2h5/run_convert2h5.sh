@@ -31,8 +31,99 @@ fi
 # the container already.)
 export CPATH=$EDEPSIM/include/EDepSim:$CPATH
 
-run ./convert_edepsim_roottoh5.py --input_file "$inFile" --output_file "$outFile" "$keepAllDets"
+# "root" (PyROOT, one entry at a time) or "bulk" (blocks of entries as flat arrays)
+engine=${ARCUBE_CONVERT2H5_ENGINE:-root}
+
+# Worker processes; >1 converts the file in shards split at spill boundaries
+nproc=${ARCUBE_CONVERT2H5_NPROC:-1}
+
+# >0 overlaps reading, converting and writing, with queues this many blocks deep
+queueDepth=${ARCUBE_CONVERT2H5_QUEUE_DEPTH:-0}
+
+# none, gzip[:level], lzf or blosc[:compressor[:level]] (needs hdf5plugin)
+compression=${ARCUBE_CONVERT2H5_COMPRESSION:-none}
+
+# >0 flushes output once this many bytes are pending, instead of every 1000 events
+flushBytes=${ARCUBE_CONVERT2H5_FLUSH_BYTES:-0}
+
+# >0 aligns the HDF5 chunks to whole spills, of up to this many bytes each
+spillChunkBytes=${ARCUBE_CONVERT2H5_SPILL_CHUNK_BYTES:-0}
+
+# Also write the mc_evtcode table of distinct GENIE EvtCodes, indexed from mc_hdr
+if [[ "$ARCUBE_CONVERT2H5_EVTCODE_TABLE" == "1" ]]; then
+    evtcodeTable=--evtcode_table
+else
+    evtcodeTable=""
+fi
+
+# Comma-separated datasets to write (e.g. segments,vertices), skipping the rest
+if [[ -n "$ARCUBE_CONVERT2H5_DATASETS" ]]; then
+    datasets="--datasets $ARCUBE_CONVERT2H5_DATASETS"
+else
+    datasets=""
+fi
+
+# Packed layout (no padding or placeholder fields); read_edepsim_h5.py unpacks it
+if [[ "$ARCUBE_CONVERT2H5_PACKED" == "1" ]]; then
+    packed=--packed
+else
+    packed=""
+fi
+
+# Parent/children rows of each trajectory and trajectory row of each segment
+if [[ "$ARCUBE_CONVERT2H5_ANCESTRY_INDEX" == "1" ]]; then
+    ancestryIndex=--ancestry_index
+else
+    ancestryIndex=""
+fi
+
+# Segment pruning: minimum dE (MeV), region boxes (JSON file, cm) and t0
+# window ("[min,max]", us from the spill start); see segment_pruning. An array,
+# so that values aren't split on spaces or expanded as glob patterns ([0,10])
+prune=()
+if [[ -n "$ARCUBE_CONVERT2H5_MIN_DE" ]]; then
+    prune+=(--min_dE "$ARCUBE_CONVERT2H5_MIN_DE")
+fi
+if [[ -n "$ARCUBE_CONVERT2H5_REGION" ]]; then
+    prune+=(--region "$ARCUBE_CONVERT2H5_REGION")
+fi
+if [[ -n "$ARCUBE_CONVERT2H5_T0_WINDOW" ]]; then
+    prune+=(--t0_window "$ARCUBE_CONVERT2H5_T0_WINDOW")
+fi
+
+# One segments/<container> dataset per segment container (with keep_all_dets)
+if [[ "$ARCUBE_CONVERT2H5_SPLIT_DETS" == "1" ]]; then
+    splitDets=--split_dets
+else
+    splitDets=""
+fi
+
+# Record progress in the output after every write and carry on from it if the
+# output is already there (e.g. after hitting a job time limit). Only covers
+# runs stopped between writes; a run killed mid-write can leave an unreadable
+# file. Needs nproc=1, no spill chunks and no split_dets.
+if [[ "$ARCUBE_CONVERT2H5_CHECKPOINT" == "1" ]]; then
+    checkpoint=--checkpoint
+else
+    checkpoint=""
+fi
+
+# Write per-phase timings, rows/s and peak memory to $outFile.profile.json
+if [[ "$ARCUBE_CONVERT2H5_PROFILE" == "1" ]]; then
+    profilePhases=--profile_phases
+else
+    profilePhases=""
+fi
+
+run ./convert_edepsim_roottoh5.py --input_file "$inFile" --output_file "$outFile" \
+    --engine "$engine" --nproc "$nproc" \
+    --queue_depth "$queueDepth" --compression "$compression" --flush_bytes "$flushBytes" \
+    --spill_chunk_bytes "$spillChunkBytes" \
+    $evtcodeTable $datasets $packed $ancestryIndex "${prune[@]}" $splitDets $checkpoint $profilePhases "$keepAllDets"
 
 h5OutDir=$outDir/EDEPSIM_H5/$subDir
 mkdir -p "$h5OutDir"
 mv "$outFile" "$h5OutDir"
+if [[ -n "$profilePhases" ]]; then
+    mv "$outFile.profile.json" "$h5OutDir"
+fi
@@ -0,0 +1,116 @@
+"""
+Tests of convert_edepsim_roottoh5.py. They need PyROOT and the TG4Event
+classes, loaded from ARCUBE_TG4EVENT_LIB (by default the library built by
+run-spill-build/makeLibTG4Event.sh) unless ROOT already has them.
+
+    python -m pytest run-convert2h5/tests
+"""
+
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT = pytest.importorskip("ROOT")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import benchmark_convert2h5
+
+tg4event_lib = os.environ.get("ARCUBE_TG4EVENT_LIB", benchmark_convert2h5.libTG4Event)
+if not (ROOT.TClass.GetClass("TG4Event") and ROOT.TClass.GetClass("TG4Event").IsLoaded()) \
+   and not os.path.exists(tg4event_lib):
+    pytest.skip(f"No TG4Event classes; set ARCUBE_TG4EVENT_LIB or build {tg4event_lib}",
+                allow_module_level=True)
+benchmark_convert2h5.loadTG4Event(tg4event_lib)
+
+import convert_edepsim_roottoh5 as convert
+
+missing_traj_id = np.iinfo(convert.segments_dtype['file_traj_id']).max
+
+# Segments without a contributor (-1) or with one that is not among the
+# event's trajectories get the traj_id fill value and PDG code 0
+def test_contributor_ids_missing():
+    trackMap = {0: 10, 1: 11, 3: 12}
+    trackPdg = {0: 13, 1: 2212, 3: 22}
+    file_traj_id, pdg_id = convert.contributorIDs(np.array([1, -1, 7, 3], dtype='i8'), trackMap, trackPdg)
+    assert file_traj_id.tolist() == [11, missing_traj_id, missing_traj_id, 12]
+    assert pdg_id.tolist() == [2212, 0, 0, 22]
+
+    segment = convert.fillSegments(np.zeros((2, 4)), np.ones((2, 4)), np.ones(2))
+    segment["file_traj_id"], segment["pdg_id"] = convert.contributorIDs(np.array([-1, 0], dtype='i8'),
+                                                                         trackMap, trackPdg)
+    assert segment["file_traj_id"].tolist() == [missing_traj_id, 10]
+    assert segment["pdg_id"].tolist() == [0, 13]
+
+# Unknown contributors are skipped, and so is an unknown parent, ending the
+# walk up the ancestry
+def test_resolve_ancestry_missing():
+    track_ids = np.array([0, 1, 2, 3], dtype='i8')
+    parent_ids = np.array([-1, 0, 1, 9], dtype='i8')
+    order = convert.resolveAncestry(track_ids, parent_ids, np.array([-1, 2, 7, 3], dtype='i8'))
+    assert order.tolist() == [0, 2, 1, 3]
+
+# Segments and trajectories whose contributor or parent is not stored get row -1
+def test_ancestry_index_missing():
+    trajectories = np.zeros(3, dtype=convert.trajectories_dtype)
+    trajectories["vertex_id"] = [5, 5, 6]
+    trajectories["traj_id"] = [0, 1, 0]
+    trajectories["parent_id"] = [-1, 0, 4]
+    traj_index, traj_children = convert.ancestryIndex(trajectories, 100, 10)
+    assert traj_index["parent_row"].tolist() == [-1, 100, -1]
+    assert traj_index["children"]["start"].tolist() == [10, 11, 11]
+    assert traj_index["children"]["stop"].tolist() == [11, 11, 11]
+    assert traj_children["traj_row"].tolist() == [101]
+
+    segments = np.zeros(3, dtype=convert.segments_dtype)
+    segments["vertex_id"] = [5, 6, 6]
+    segments["traj_id"] = [1, 0, missing_traj_id]
+    assert convert.segmentIndex(trajectories, segments, 100)["traj_row"].tolist() == [101, 102, -1]
+    assert convert.segmentIndex(trajectories[:0], segments, 100)["traj_row"].tolist() == [-1, -1, -1]
+
+# Small synthetic input, as benchmark_convert2h5.py writes it
+@pytest.fixture(scope="module")
+def input_file(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("input") / "test.EDEPSIM_SPILLS.root")
+    benchmark_convert2h5.declareInputWriter()
+    ROOT.convert2h5bench_writeInput(path, 2, 3, 6, 3, 2, 5, 1.2, 1)
+    return path
+
+# Only the branches the datasets need are read
+@pytest.mark.parametrize("datasets, enabled", [
+    ("segments", []),
+    ("segments,vertices", ["Primaries", "Primaries.Position"]),
+    ("trajectories", ["Trajectories.Points", "Trajectories.InitialMomentum"]),
+])
+def test_select_branches(input_file, datasets, enabled):
+    inputFile, inputTree, genieTree, spill_map, spillPeriod_s = convert.openInput(input_file)
+    convert.selectBranches(inputTree, datasets.split(","))
+
+    always = ["RunId", "EventId", "SegmentDetectors", "SegmentDetectors.first", "SegmentDetectors.second",
+              "Trajectories", "Trajectories.TrackId", "Trajectories.ParentId", "Trajectories.PDGCode"]
+    for branch in inputTree.GetListOfLeaves():
+        name = branch.GetBranch().GetName()
+        if name == "Event":
+            continue
+        assert inputTree.GetBranchStatus(name) == (name in always + enabled), name
+
+    assert inputTree.GetEntry(0) > 0
+    event = inputTree.Event
+    assert event.EventId == 0 and len(event.SegmentDetectors) == 2 and len(event.Trajectories) == 6
+    assert len(event.Primaries) == (1 if "vertices" in datasets else 0)
+    assert len(event.Trajectories[0].Points) == (3 if "trajectories" in datasets else 0)
+
+# Container names too long for segment_containers are refused, not cut
+def test_container_row_long_name():
+    width = convert.segment_containers_dtype["detector"].itemsize
+    assert convert.containerRow(1, 2, "v" * width, 0, 3)["detector"][0] == b"v" * width
+    with pytest.raises(ValueError):
+        convert.containerRow(1, 2, "v" * (width + 1), 0, 3)
+
+# Spill map keys are unique for every run and event id they accept
+def test_spill_map_key_range():
+    keys = convert.spillMapKey([-2**31, 0, 0, 2**31 - 1], [2**32 - 1, 0, 2**32 - 1, 0])
+    assert len(np.unique(keys)) == 4
+    for run_id, event_id in [(0, 2**32), (0, -1), (2**31, 0)]:
+        with pytest.raises(ValueError):
+            convert.spillMapKey([run_id], [event_id])